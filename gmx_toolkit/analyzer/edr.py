@@ -0,0 +1,282 @@
+import struct
+import numpy as np
+import pandas as pd
+
+# GROMACS の enxio (.edr の形式) の版と識別子
+ENX_VERSION = 5
+_NAMES_MAGIC = -55555
+_FRAME_MAGIC = -7777777
+# サブブロックの型 (xdr_datatype: int, float, double, int64, char, string) ごとの 1 要素の dtype。
+# XDR では char も 4 バイトになる。string は長さが可変なので別に読む。
+_SUBBLOCK_DTYPES = {0: ">i4", 1: ">f4", 2: ">f8", 3: ">i8", 4: ">u4"}
+_STRING = 5
+
+
+class EdrFile:
+    """
+    GROMACS の .edr (XDR 形式のエネルギーファイル) を gmx energy を使わずに読む。
+
+    ファイル全体を一度に読み込み、全フレームの全項目を (フレーム数,項目数) の配列にする。
+    フレームの並びが一定 (同じ項目・同じブロック構成) の部分は numpy の strided view でまとめて
+    取り出すので、フレームごとの Python の処理は構成が変わるところだけになる。
+    実数の精度 (単精度/倍精度の GROMACS) はファイルから判定する。最初のフレームが書き込み途中の
+    ファイル (実行中の mdrun の出力など) は real が None になり、フレームを読まない。
+    gmx energy と同じく、項目を持たないフレーム (ブロックだけのフレーム) は使わない。
+    """
+
+    def __init__(self,path):
+        """
+        引数:
+            path (str): .edr ファイル
+        """
+        self.path = path
+        with open(path,"rb") as f:
+            self.buffer = f.read()
+        self.names, self.units, self.file_version, self.header_size = self._read_names()
+        self.real = self._detect_precision()
+
+    def _read_names(self):
+        magic, = struct.unpack_from(">i",self.buffer,0)
+        if magic > 0:
+            # GROMACS 4.0 より前の形式は先頭が項目数
+            file_version, n_terms, pos = 1, magic, 4
+        elif magic != _NAMES_MAGIC:
+            raise ValueError(f"{self.path} is not a GROMACS .edr file")
+        else:
+            file_version, n_terms = struct.unpack_from(">ii",self.buffer,4)
+            pos = 12
+        if file_version > ENX_VERSION:
+            raise ValueError(f"{self.path} has .edr file_version {file_version} (> {ENX_VERSION})")
+        names, units = [], []
+        for _ in range(n_terms):
+            name, pos = self._xdr_string(pos)
+            names.append(name)
+            if file_version >= 2:
+                unit, pos = self._xdr_string(pos)
+            else:
+                unit = "kJ/mol"
+            units.append(unit)
+        return names, units, file_version, pos
+
+    def _xdr_string(self,pos):
+        length, = struct.unpack_from(">I",self.buffer,pos)
+        pos += 4
+        text = self.buffer[pos:pos+length].decode("ascii",errors="replace")
+        return text, pos + (length + 3)//4*4
+
+    def _detect_precision(self):
+        # gmx と同じく、最初のフレームをそれぞれの精度で読んでみて項目数が合う方を使う
+        if len(self.buffer) <= self.header_size:
+            # フレームが無い
+            return np.dtype(">f4")
+        found = []
+        truncated = False
+        for real in (">f4",">f8"):
+            self.real = np.dtype(real)
+            try:
+                header = self._read_frame_header(self.header_size)
+            except (EOFError,struct.error):
+                truncated = True
+                continue
+            except ValueError:
+                continue
+            if header["n_terms"] == len(self.names):
+                return self.real
+            if header["n_terms"] == 0:
+                # 項目の無いフレームは精度を間違えても読めてしまうことがあるので、合う方が無いときだけ使う
+                found.append(self.real)
+        if found:
+            self.real = found[0]
+            return self.real
+        if truncated:
+            # 最初のフレームが書き込み途中 (mdrun の実行中など) で、読めるフレームはまだ無い
+            return None
+        raise ValueError(f"cannot read the first frame of {self.path}: corrupted .edr")
+
+    def _read_frame_header(self,pos):
+        """
+        pos から始まるフレームのヘッダを読む。
+
+        戻り値:
+            dict: フレームの先頭からの time, step, nsum の位置と time, step の dtype、n_terms、
+                n_values (項目ごとの実数の数)、energy (エネルギーの位置)、size (フレームのバイト数)、
+                varying (フレームごとに変わるヘッダの (位置, バイト数))、strings (可変長のブロックがあるか)
+        """
+        real = self.real.itemsize
+        first, = struct.unpack_from(">d" if real == 8 else ">f",self.buffer,pos)
+        p = pos + real
+        if first > -1e9:
+            # GROMACS 4.0 より前の形式: 先頭の実数が時刻で、次が int の step
+            t, (step,) = first, struct.unpack_from(">i",self.buffer,p)
+            if not (0 <= t < 1e20 and step >= 0):
+                raise ValueError(f"broken energy frame at byte {pos} of {self.path}")
+            file_version, nsum = 1, None
+            time_offset, time_dtype, step_dtype = 0, self.real, np.dtype(">i4")
+            varying = [(0,real + 4)]
+            p += 4
+        else:
+            magic, file_version = struct.unpack_from(">ii",self.buffer,p)
+            if magic != _FRAME_MAGIC or file_version > ENX_VERSION:
+                raise ValueError(f"broken energy frame at byte {pos} of {self.path}")
+            p += 8
+            time_offset, time_dtype, step_dtype = p - pos, np.dtype(">f8"), np.dtype(">i8")
+            _, _, nsum = struct.unpack_from(">dqi",self.buffer,p)
+            varying = [(time_offset,20)]  # 時刻, step, nsum
+            p += 20
+        if file_version >= 3:
+            varying.append((p - pos,8))  # nsteps
+            p += 8
+        if file_version >= 5:
+            p += 8  # dt
+        n_terms, ndisre, n_blocks = struct.unpack_from(">iii",self.buffer,p)
+        p += 12
+        if file_version >= 4:
+            ndisre = 0
+        # (型, 要素数) のサブブロック
+        subblocks = []
+        if ndisre > 0:
+            subblocks += [(1 if real == 4 else 2,ndisre)]*2
+        for _ in range(n_blocks):
+            if file_version < 4:
+                nr, = struct.unpack_from(">i",self.buffer,p)
+                p += 4
+                subblocks.append((1 if real == 4 else 2,nr))
+            else:
+                _, nsub = struct.unpack_from(">ii",self.buffer,p)
+                p += 8
+                for _ in range(nsub):
+                    subblocks.append(struct.unpack_from(">ii",self.buffer,p))
+                    p += 8
+        p += 12  # e_size と予約の 2 つ
+        energy = p
+        # 和を平均するフレームは各項目が (値, 平均, 和) の組、古い形式はさらに使われない実数が続く
+        n_values = 4 if file_version == 1 else 3 if nsum > 0 else 1
+        p += n_terms*n_values*real
+        strings = False
+        for kind, nr in subblocks:
+            if kind == _STRING:
+                strings = True
+                for _ in range(nr):
+                    p += 4
+                    _, p = self._xdr_string(p)
+            elif kind in _SUBBLOCK_DTYPES:
+                p += nr*np.dtype(_SUBBLOCK_DTYPES[kind]).itemsize
+            else:
+                raise ValueError(f"unknown block data type {kind} at byte {pos} of {self.path}")
+        if p > len(self.buffer):
+            raise EOFError
+        return dict(
+            time=time_offset,time_dtype=time_dtype,step=time_offset + time_dtype.itemsize,step_dtype=step_dtype,
+            nsum=None if nsum is None else time_offset + 16,n_terms=n_terms,n_values=n_values,
+            energy=energy - pos,size=p - pos,varying=varying,strings=strings,
+        )
+
+    def _same_layout(self,pos,header):
+        """
+        pos のフレームから、時刻・step・nsum 以外のヘッダが同じフレームが続く範囲を返す。
+
+        ヘッダが同じならフレームの大きさも同じなので、続くフレームは (n,size) の配列として扱える。
+
+        戻り値:
+            np.ndarray: (n,size) の uint8。n >= 1。
+        """
+        size = header["size"]
+        n_rest = (len(self.buffer) - pos)//size
+        frames = np.frombuffer(self.buffer,dtype=np.uint8,count=n_rest*size,offset=pos).reshape(n_rest,size)
+        if header["strings"]:
+            return frames[:1]
+        keep = np.ones(header["energy"],dtype=bool)
+        for offset, length in header["varying"]:
+            keep[offset:offset+length] = False
+        reference = frames[0,:header["energy"]][keep]
+        # 構成が変わる位置を早く見つけられるよう、比べる行数を倍々に増やす
+        n, block = 1, 16
+        while n < n_rest:
+            same = np.all(frames[n:n+block,:header["energy"]][:,keep] == reference,axis=1)
+            if not same.all():
+                n += int(np.argmin(same))
+                break
+            n += len(same)
+            block *= 2
+        # 和の有無 (nsum > 0) が変わるとエネルギーの並びが変わる
+        offset = header["nsum"]
+        if offset is not None:
+            nsum = frames[:n,offset:offset+4].copy().view(">i4")[:,0]
+            changed = (nsum > 0) != (header["n_values"] == 3)
+            if changed.any():
+                n = int(np.argmax(changed))
+        return frames[:n]
+
+    @staticmethod
+    def _column(frames,offset,dtype):
+        """(n,size) のフレームの offset にある dtype の値を (n,) で取り出す。"""
+        return frames[:,offset:offset+dtype.itemsize].copy().view(dtype)[:,0]
+
+    def read(self,begin=0,end=None,stride=1,terms=None):
+        """
+        全フレームから時間範囲と stride で選んだフレームの項目を読む。
+
+        引数:
+            begin (float): この時刻 (ps) より前のフレームは使わない
+            end (float, optional): この時刻 (ps) より後のフレームは使わない
+            stride (int): 時間範囲内のフレームをこの間隔で使う
+            terms (list of str, optional): 読む項目名。None ならすべて。
+
+        戻り値:
+            tuple: (time (F,), step (F,), values (F,項目数) float64, 項目名のリスト)
+        """
+        columns = np.arange(len(self.names)) if terms is None else np.array([self.names.index(t) for t in terms])
+        names = [self.names[k] for k in columns]
+        times, steps, values = [], [], []
+        n_inside = 0  # これまでの時間範囲内のフレーム数 (stride の判定用)
+        pos = self.header_size if self.real is not None else len(self.buffer)
+        while pos < len(self.buffer):
+            try:
+                header = self._read_frame_header(pos)
+            except (EOFError,struct.error):
+                # 書き込み途中で終わったフレームは使わない
+                break
+            frames = self._same_layout(pos,header)
+            pos += len(frames)*header["size"]
+            if header["n_terms"] == 0:
+                continue
+            if header["n_terms"] != len(self.names):
+                raise ValueError(f"energy frame with {header['n_terms']} terms in {self.path} ({len(self.names)} names)")
+            t = self._column(frames,header["time"],header["time_dtype"])
+            inside = t >= begin
+            if end is not None:
+                inside &= t <= end
+            use = inside & ((n_inside + np.cumsum(inside) - 1) % stride == 0)
+            n_inside += int(inside.sum())
+            if use.any():
+                width = header["n_terms"]*header["n_values"]*self.real.itemsize
+                energy = frames[use,header["energy"]:header["energy"]+width].copy().view(self.real)
+                times.append(t[use])
+                steps.append(self._column(frames[use],header["step"],header["step_dtype"]))
+                values.append(energy.reshape(-1,header["n_terms"],header["n_values"])[:,columns,0])
+        if not times:
+            return np.zeros(0), np.zeros(0,dtype=np.int64), np.zeros((0,len(columns))), names
+        return (
+            np.concatenate(times).astype(np.float64),np.concatenate(steps).astype(np.int64),
+            np.concatenate(values).astype(np.float64),names
+        )
+
+
+def read_edr(edr,begin=0,end=None,stride=1,terms=None):
+    """
+    .edr の全項目を 1 回のパスで読み込み、DataFrame にする。
+
+    引数:
+        edr (str): .edr ファイル
+        その他の引数は EdrFile.read と同じ。
+
+    戻り値:
+        pd.DataFrame: "Time" (ps), "Step" と各項目の列。単位は attrs["units"] に {項目名: 単位} で入る。
+    """
+    edr_file = EdrFile(edr)
+    times, steps, values, names = edr_file.read(begin=begin,end=end,stride=stride,terms=terms)
+    df = pd.DataFrame(values,columns=names)
+    df.insert(0,"Step",steps)
+    df.insert(0,"Time",times)
+    df.attrs["units"] = {name: unit for name, unit in zip(edr_file.names,edr_file.units) if name in names}
+    return df
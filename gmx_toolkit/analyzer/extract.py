@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import mdtraj as md
+
+
+def file_fingerprint(path,n_samples=16,sample_size=2**16):
+    """
+    ファイルの内容のハッシュ (sha1)。
+
+    トラジェクトリ全体を読むと解析そのものと同じだけ時間がかかるので、ファイルサイズ・先頭と
+    末尾の 1MB・等間隔の n_samples 箇所の sample_size バイトから求める。
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path,"rb") as f:
+        if size <= 2**21 + n_samples*sample_size:
+            digest.update(f.read())
+            return digest.hexdigest()
+        digest.update(f.read(2**20))
+        for offset in np.linspace(2**20,size - 2**20 - sample_size,n_samples).astype(np.int64):
+            f.seek(int(offset))
+            digest.update(f.read(sample_size))
+        f.seek(size - 2**20)
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def find_extract(gro,trr,directory,atoms_idx=None,stride=1,begin=0,end=None,fingerprints=None):
+    """
+    directory にある縮約トラジェクトリのうち、条件のフレームと原子をすべて含むものを探す。
+
+    元の .gro と .trr の内容が同じで、原子が atoms_idx を含み、stride が元の stride の倍数で、
+    時間範囲が [begin,end) を含むものが使える。複数あれば最も小さいファイルを選ぶ。
+
+    引数:
+        fingerprints (dict, optional): 計算済みの {path: file_fingerprint(path)}
+        その他の引数は extract_trajectory と同じ。
+
+    戻り値:
+        dict or None: extract_trajectory と同じ縮約トラジェクトリの情報。無ければ None。
+    """
+    if not os.path.isdir(directory):
+        return None
+    fingerprints = fingerprints or {}
+    source = dict(
+        gro=fingerprints.get(gro) or file_fingerprint(gro),
+        trr=fingerprints.get(trr) or file_fingerprint(trr),
+    )
+    found = None
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory,name)) as f:
+                info = json.load(f)
+        except (OSError,ValueError):
+            continue
+        if info.get("source_sha1") != source:
+            continue
+        if stride % info["stride"] != 0 or info["begin"] > begin:
+            continue
+        if info["end"] is not None and (end is None or end > info["end"]):
+            continue
+        atoms = np.array(info["atoms"],dtype=int)
+        if atoms_idx is not None and not np.all(np.isin(atoms_idx,atoms)):
+            continue
+        info["gro"] = os.path.join(directory,info["gro"])
+        info["trr"] = os.path.join(directory,info["trr"])
+        if not (os.path.exists(info["gro"]) and os.path.exists(info["trr"])):
+            continue
+        info["atoms"] = atoms
+        info["size"] = os.path.getsize(info["trr"])
+        if found is None or info["size"] < found["size"]:
+            found = info
+    return found
+
+
+def extract_trajectory(gro,trr,directory,atoms_idx=None,stride=1,begin=0,end=None,chunk=100):
+    """
+    トラジェクトリから一部の原子・stride ごとのフレーム・時間範囲だけを取り出した縮約トラジェクトリを作る。
+
+    本番のトラジェクトリは系全体を速度付きで細かく書き出しているが、水だけや MOL だけの解析では
+    その一部しか使わない。縮約トラジェクトリは座標と箱だけを .trr に書き、対応する .gro と、
+    元のファイル (パスと内容のハッシュ) と条件を記録した .json を directory に置く。
+    条件を満たすもの (find_extract) が既にあれば作らずにそれを返すので、同じ解析を繰り返すときは
+    縮約トラジェクトリだけを読めばよい。
+
+    取り出すフレームは元のトラジェクトリの stride の倍数番目のうち、時刻が begin 以上 end 未満のもの。
+    縮約トラジェクトリの k 番目のフレームは元の first + k*stride 番目になる。
+
+    引数:
+        gro (str): 元のトポロジー (.gro)
+        trr (str): 元のトラジェクトリ
+        directory (str): 縮約トラジェクトリを置くディレクトリ
+        atoms_idx (array-like, optional): 取り出す原子のインデックス。None ならすべての原子。
+        stride (int): 取り出すフレームの間隔
+        begin (float): この時刻 (ps) より前のフレームは取り出さない
+        end (float, optional): この時刻 (ps) 以降のフレームは取り出さない
+        chunk (int): 一度に読み込むフレーム数
+
+    戻り値:
+        dict: gro, trr (縮約トラジェクトリのパス), atoms (元の原子インデックス), stride, begin, end,
+            first (最初のフレームの元の番号), n_frames, source (元のパス), source_sha1 など。
+    """
+    fingerprints = {gro: file_fingerprint(gro),trr: file_fingerprint(trr)}
+    if atoms_idx is not None:
+        atoms_idx = np.unique(np.asarray(atoms_idx,dtype=int))
+    found = find_extract(gro,trr,directory,atoms_idx,stride,begin,end,fingerprints=fingerprints)
+    if found is not None:
+        return found
+    topology = md.load_topology(gro)
+    atoms = np.arange(topology.n_atoms) if atoms_idx is None else atoms_idx
+    info = dict(
+        source=dict(gro=os.path.abspath(gro),trr=os.path.abspath(trr)),
+        source_sha1=dict(gro=fingerprints[gro],trr=fingerprints[trr]),
+        atoms=atoms.tolist(),stride=stride,begin=begin,end=end,
+    )
+    key = hashlib.sha1(json.dumps(info,sort_keys=True).encode()).hexdigest()[:16]
+    root = os.path.splitext(os.path.basename(trr))[0]
+    name = f"{root}_{key}"
+    os.makedirs(directory,exist_ok=True)
+    tmp = os.path.join(directory,f"{name}.{os.getpid()}.tmp.trr")
+    first = None
+    n_frames = 0
+    n_read = 0
+    with md.formats.TRRTrajectoryFile(tmp,"w") as out:
+        # mdtraj の TRR は stride と atom_indices を同時に渡すとメモリを壊すので、原子は読んでから選ぶ
+        for frames in md.iterload(trr,top=gro,chunk=chunk,stride=stride):
+            use = frames.time >= begin
+            if end is not None:
+                use &= frames.time < end
+            if first is None and np.any(use):
+                first = (n_read + int(np.argmax(use)))*stride
+            if np.any(use):
+                out.write(
+                    frames.xyz[use][:,atoms],time=frames.time[use],box=frames.unitcell_vectors[use]
+                )
+                n_frames += int(use.sum())
+            n_read += len(frames)
+            if end is not None and frames.time[-1] >= end:
+                break
+    if n_frames == 0:
+        os.remove(tmp)
+        raise ValueError(f"no frames in [{begin},{end}) ps in {trr}")
+    os.replace(tmp,os.path.join(directory,f"{name}.trr"))
+    md.load(gro,atom_indices=atoms).save_gro(os.path.join(directory,f"{name}.gro"))
+    info.update(
+        gro=f"{name}.gro",trr=f"{name}.trr",first=first,n_frames=n_frames,
+        created=time.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    # .json があることを完成の印にするので最後に書く
+    path = os.path.join(directory,f"{name}.json")
+    with open(f"{path}.{os.getpid()}.tmp","w") as f:
+        json.dump(info,f,indent=1)
+    os.replace(f"{path}.{os.getpid()}.tmp",path)
+    return find_extract(gro,trr,directory,atoms,stride,begin,end,fingerprints=fingerprints)
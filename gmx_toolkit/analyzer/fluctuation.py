@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+# 気体定数 (kJ/(mol K)) とボルツマン定数 (J/K)
+R_KJ = 8.314462618e-3
+KB = 1.380649e-23
+# GROMACS の PRESFAC (bar / (kJ mol^-1 nm^-3))
+PRESFAC = 16.6054
+
+
+def statistical_inefficiency(x):
+    """
+    時系列 x の統計的非効率 g = 1 + 2 Σ_t C(t) (1 - t/N)。独立なサンプル数は N/g になる。
+
+    自己相関 C(t) は FFT で求め、最初に 0 以下になったところで和を打ち切る。
+    """
+    x = np.asarray(x,dtype=np.float64)
+    n = len(x)
+    if n < 2:
+        return 1.0
+    dx = x - x.mean()
+    variance = dx @ dx / n
+    if variance == 0:
+        return 1.0
+    spectrum = np.fft.rfft(dx,2*n)
+    acf = np.fft.irfft(spectrum*np.conj(spectrum))[1:n] / (variance*(n - np.arange(1,n)))
+    negative = np.flatnonzero(acf <= 0)
+    stop = negative[0] if len(negative) > 0 else len(acf)
+    t = np.arange(1,stop + 1)
+    return max(1.0,1.0 + 2.0*np.sum(acf[:stop]*(1.0 - t/n)))
+
+
+def detect_equilibration(series,n_candidates=50,max_fraction=0.5):
+    """
+    平衡化の終わり t0 を、t0 以降の有効サンプル数 (N - t0)/g が最大になる位置として求める。
+
+    series に複数の時系列 (F,K) を渡すと、各 t0 で最も少ない有効サンプル数を最大にする。
+
+    引数:
+        series (array-like): (F,) または (F,K) の時系列
+        n_candidates (int): 調べる t0 の数
+        max_fraction (float): 捨てるフレームの割合の上限
+
+    戻り値:
+        tuple: (t0 (フレーム番号), t0 以降の g (系列ごとの最大), 有効サンプル数)
+    """
+    series = np.asarray(series,dtype=np.float64)
+    if series.ndim == 1:
+        series = series[:,None]
+    n = len(series)
+    best = (0,1.0,float(n))
+    for t0 in np.unique(np.linspace(0,int(n*max_fraction),n_candidates).astype(int)):
+        if n - t0 < 2:
+            break
+        g = max(statistical_inefficiency(series[t0:,k]) for k in range(series.shape[1]))
+        n_eff = (n - t0)/g
+        if t0 == 0 or n_eff > best[2]:
+            best = (int(t0),g,n_eff)
+    return best
+
+
+def block_bootstrap_means(columns,block_length,n_bootstrap=200,rng=None):
+    """
+    列ごとの平均のブロックブートストラップ。
+
+    時系列を block_length フレームの重ならないブロックに分け、ブロックを復元抽出して平均を求める。
+    ブロックごとの和だけを使うので、抽出は (n_bootstrap,ブロック数) の回数の行列との積になる。
+    分散や共分散は、積の列 (x^2, xy) の平均から求める。
+
+    引数:
+        columns (np.ndarray): (F,P) の時系列
+        block_length (int): ブロックのフレーム数。先頭の F % block_length フレームは使わない。
+        n_bootstrap (int): ブートストラップの回数
+        rng (np.random.Generator, optional)
+
+    戻り値:
+        np.ndarray: (n_bootstrap,P) の各回の平均
+    """
+    rng = rng or np.random.default_rng()
+    columns = np.asarray(columns,dtype=np.float64)
+    n_blocks = len(columns)//block_length
+    if n_blocks < 2:
+        raise ValueError(f"{len(columns)} frames are too few for blocks of {block_length} frames")
+    used = columns[len(columns) - n_blocks*block_length:]
+    block_sums = used.reshape(n_blocks,block_length,-1).sum(axis=1)  # (B,P)
+    counts = rng.multinomial(n_blocks,np.full(n_blocks,1.0/n_blocks),size=n_bootstrap)  # (n_bootstrap,B)
+    return counts @ block_sums / (n_blocks*block_length)
+
+
+def _properties(means,temperature,n_molecules,gas_potential):
+    """
+    fluctuation_properties の列の平均 (...,9) から各物性を求める。
+
+    列は [密度, V, H, U, dV^2, dH^2, dV dH, dV, dH] で、d は全体の平均からのずれ。
+    """
+    density, volume, _, potential, dv2, dh2, dvdh, dv, dh = np.moveaxis(means,-1,0)
+    var_h = dh2 - dh**2
+    var_v = dv2 - dv**2
+    cov_vh = dvdh - dv*dh
+    properties = {
+        # kg/m^3
+        "density": density,
+        # J/(mol K): 箱全体の H (kJ/mol) の揺らぎを分子 1 mol あたりにする
+        "cp": var_h/(R_KJ*temperature**2)*1000/n_molecules,
+        # 1/bar: nm^3 を m^3 に (1e-27)、1/Pa を 1/bar に (1e5) 直す
+        "kappa_T": var_v/(KB*temperature*volume)*1e-27*1e5,
+        # 1/K
+        "alpha_P": cov_vh/(R_KJ*temperature**2*volume),
+        # kJ/mol
+        "dHvap": gas_potential - potential/n_molecules + R_KJ*temperature,
+    }
+    return properties
+
+
+UNITS = {
+    "density": "kg/m^3","cp": "J/(mol K)","kappa_T": "1/bar","alpha_P": "1/K","dHvap": "kJ/mol",
+}
+
+
+def fluctuation_properties(data,n_molecules=1,temperature=None,gas_potential=None,equilibration="auto",
+                           n_bootstrap=200,block_length=None,seed=None):
+    """
+    NPT のエネルギーの時系列 (read_edr の DataFrame) から揺らぎの式で熱力学量を求める。
+
+        密度           <ρ>
+        定圧熱容量     Cp = var(H) / (R T^2)
+        等温圧縮率     κT = var(V) / (kB T <V>)
+        熱膨張係数     αP = cov(V,H) / (R T^2 <V>)
+        蒸発エンタルピー ΔHvap = <U_gas> - <U_liq>/N + RT
+
+    H は Enthalpy の項 (無ければ Total Energy + pV)。Cp と ΔHvap は分子 1 mol あたりにする。
+    平衡化の部分は detect_equilibration で自動的に除き、誤差はブロックブートストラップの標準偏差とする。
+    古典的な揺らぎの式なので、Cp に量子補正は入らない。
+
+    引数:
+        data (pd.DataFrame): read_edr の結果 (Time, Density, Volume, Enthalpy, Potential, Temperature など)
+        n_molecules (int): 系の分子数。Cp と ΔHvap を 1 分子 (1 mol) あたりにするのに使う。
+        temperature (float, optional): 温度 (K)。None なら Temperature の平均。
+        gas_potential (float, optional): 気相の 1 分子のポテンシャルエネルギーの平均 (kJ/mol)。
+            None なら ΔHvap は NaN。
+        equilibration: "auto" なら自動で判定、数値ならその時刻 (ps) より前を捨てる、None なら捨てない。
+        n_bootstrap (int): ブートストラップの回数
+        block_length (int, optional): ブロックのフレーム数。None なら統計的非効率 g の 2 倍。
+        seed (int, optional): ブートストラップの乱数の種
+
+    戻り値:
+        pd.DataFrame: property, mean, error, unit の列。attrs に t0 (ps), n_frames,
+            statistical_inefficiency, block_length, temperature が入る。
+    """
+    n = len(data)
+
+    def column(name):
+        return data[name].to_numpy(dtype=np.float64) if name in data else np.full(n,np.nan)
+
+    volume = column("Volume")
+    if "Enthalpy" in data:
+        enthalpy = column("Enthalpy")
+    elif "pV" in data:
+        enthalpy = column("Total Energy") + column("pV")
+    else:
+        enthalpy = column("Total Energy") + np.nanmean(column("Pressure"))*volume/PRESFAC
+    potential = column("Potential")
+    time = column("Time")
+    # 平衡化と相関時間は揺らぎを使う量 (V, H) とポテンシャルエネルギーで判定する (NVT では V が無い)
+    finite = [k for k,s in enumerate((volume,enthalpy,potential)) if n > 0 and np.all(np.isfinite(s))]
+    if equilibration == "auto":
+        t0 = detect_equilibration(np.stack([volume,enthalpy,potential],axis=1)[:,finite])[0] if finite else 0
+    elif equilibration is None:
+        t0 = 0
+    else:
+        t0 = int(np.searchsorted(time,equilibration))
+    density, volume, enthalpy, potential = (
+        s[t0:] for s in (column("Density"),volume,enthalpy,potential)
+    )
+    if len(volume) < 4:
+        raise ValueError(f"only {len(volume)} frames after equilibration (t0 = {time[min(t0,n-1)]} ps)")
+    if temperature is None:
+        temperature = float(np.nanmean(column("Temperature")[t0:]))
+    g = max((statistical_inefficiency((volume,enthalpy,potential)[k]) for k in finite),default=1.0)
+    if block_length is None:
+        block_length = max(1,min(int(np.ceil(2*g)),len(volume)//10))
+    dv = volume - np.mean(volume)
+    dh = enthalpy - np.mean(enthalpy)
+    columns = np.stack([density,volume,enthalpy,potential,dv**2,dh**2,dv*dh,dv,dh],axis=1)
+    gas = np.nan if gas_potential is None else gas_potential
+    estimate = _properties(columns.mean(axis=0),temperature,n_molecules,gas)
+    replicates = _properties(
+        block_bootstrap_means(columns,block_length,n_bootstrap,np.random.default_rng(seed)),
+        temperature,n_molecules,gas
+    )
+    result = pd.DataFrame(dict(
+        property=list(estimate),
+        mean=[float(estimate[name]) for name in estimate],
+        error=[float(np.std(replicates[name],ddof=1)) for name in estimate],
+        unit=[UNITS[name] for name in estimate],
+    ))
+    result.attrs.update(
+        t0=float(time[t0]) if n > 0 else 0.0,n_frames=len(volume),statistical_inefficiency=g,
+        block_length=block_length,temperature=temperature,
+    )
+    return result
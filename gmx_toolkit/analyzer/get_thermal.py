@@ -1,22 +1,34 @@
 import os
-from gmx_toolkit.runner.gmx_run import run_command_with_input
+import re
+import glob
+from gmx_toolkit.analyzer.edr import read_edr
+from gmx_toolkit.analyzer.xvg import read_xvg
+from gmx_toolkit.analyzer.fluctuation import fluctuation_properties, detect_equilibration
+from gmx_toolkit.analyzer.prefetch import Prefetcher
+from gmx_toolkit.analyzer.extract import extract_trajectory, file_fingerprint
 import opt_axes
 import pandas as pd
 import mdtraj as md
 import numpy as np
-import torch
-from torch.utils.data import DataLoader, TensorDataset
+try:
+    import torch
+except ImportError:
+    # CPU専用ノードでは torch が無くても numpy バックエンドで計算できる
+    torch = None
 import time
+import math
+import json
+import hashlib
+import tracemalloc
+from functools import lru_cache
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.interpolate import interp1d
 import pandas as pd
 
 def xvg_to_df(xvg):
-
-    with open(xvg) as f:
-        lines = f.readlines()
-    lines = [line.split() for line in lines]
-    df = pd.DataFrame(lines,columns=["X","Y"])
-    return df
+    """.xvg を float の DataFrame にする (read_xvg)。列名は X と各 legend (無ければ Y)。"""
+    return read_xvg(xvg)
 
 class GmxEnergy:
 
@@ -24,53 +36,667 @@ class GmxEnergy:
 
         self.edr = edr 
         self.xvg = None
+        self.data = None
+        self._window = None
 
-    
-    def run(self,thermo="density"):
+    def load(self,begin=0,end=None,stride=1):
+        """
+        .edr の全項目を gmx energy を使わずに 1 回で読み込み、self.data (DataFrame) に入れる。
+
+        引数:
+            begin (float): この時刻 (ps) より前のフレームは使わない
+            end (float, optional): この時刻 (ps) より後のフレームは使わない
+            stride (int): 時間範囲内のフレームをこの間隔で使う
+
+        戻り値:
+            pd.DataFrame: "Time", "Step" と各項目の列 (read_edr)。
+        """
+        self.data = read_edr(self.edr,begin=begin,end=end,stride=stride)
+        self._window = (begin,end,stride)
+        return self.data
+
+    def term(self,thermo):
+        """thermo に当たる項目名。gmx energy と同じく大文字小文字を区別せず、一意な前方一致も許す。"""
+        names = list(self.data.columns[2:])
+        matches = [name for name in names if name.lower() == thermo.lower()]
+        if not matches:
+            matches = [name for name in names if name.lower().startswith(thermo.lower())]
+        if len(matches) != 1:
+            raise KeyError(f"'{thermo}' matches {matches or 'no term'} in {self.edr}: choose from {names}")
+        return matches[0]
+
+    def run(self,thermo="density",begin=0,end=None,stride=1):
+        """
+        thermo の時系列を self.df (X: 時刻 (ps), Y: 値) に入れる。
+
+        同じ時間範囲で読み込み済みなら .edr を読み直さないので、複数の項目を続けて取り出せる。
+        """
+        if self.data is None or self._window != (begin,end,stride):
+            self.load(begin=begin,end=end,stride=stride)
+        column = self.term(thermo)
+        self.df = pd.DataFrame({"X": self.data["Time"],"Y": self.data[column]})
 
-        self.xvg = os.path.splitext(self.edr)[0]+f"_{thermo}.xvg"
-        command = f"gmx energy -f {self.edr} -o {self.xvg} -xvg none"
-        run_command_with_input(
-            command=command,
-            input_data="density"
+    def fluctuation_properties(self,n_molecules=1,temperature=None,gas=None,begin=0,end=None,stride=1,
+                               equilibration="auto",n_bootstrap=200,block_length=None,seed=None):
+        """
+        揺らぎの式で密度・定圧熱容量・等温圧縮率・熱膨張係数・蒸発エンタルピーを求める。
+
+        .edr は 1 回だけ読み、平衡化の除去と誤差 (ブロックブートストラップ) は
+        fluctuation_properties で行う。
+
+        引数:
+            gas (float or str or GmxEnergy, optional): 気相 1 分子の計算。.edr のパスか GmxEnergy なら
+                平衡化を除いた Potential の平均を、数値ならそれを 1 分子のポテンシャルエネルギー (kJ/mol)
+                として ΔHvap に使う。None なら ΔHvap は NaN。
+            その他の引数は load と fluctuation_properties と同じ。
+
+        戻り値:
+            pd.DataFrame: property, mean, error, unit の列 (fluctuation_properties)。
+        """
+        if self.data is None or self._window != (begin,end,stride):
+            self.load(begin=begin,end=end,stride=stride)
+        gas_potential = gas
+        if isinstance(gas,str):
+            gas = GmxEnergy(gas)
+        if isinstance(gas,GmxEnergy):
+            if gas.data is None:
+                gas.load(begin=begin,end=end,stride=stride)
+            potential = gas.data[gas.term("Potential")].to_numpy()
+            gas_potential = float(np.mean(potential[detect_equilibration(potential)[0]:]))
+        self.properties = fluctuation_properties(
+            self.data,n_molecules=n_molecules,temperature=temperature,gas_potential=gas_potential,
+            equilibration=equilibration,n_bootstrap=n_bootstrap,block_length=block_length,seed=seed
         )
-        self.df = xvg_to_df(self.xvg)
+        return self.properties
     
     
-class WaxsCalculator:
+# RunThrow の出力名 {系}_{温度 (小数点は p)}_{段階}.tpr.edr
+_EDR_LABEL = re.compile(r"^(?P<system>.+)_(?P<T>\d+(?:p\d+)?)_(?P<stage>em|nvt|npt|production)(?:\.tpr)?\.edr$")
+
+
+def energy_label(edr):
+    """
+    .edr のパスから (系, 温度 (K)) を取り出す。
+
+    RunThrow の出力名 (例: water_301p15_production.tpr.edr) に合わなければ、
+    系は拡張子を除いたファイル名、温度は None (batch_energy では Temperature の平均) になる。
+    """
+    name = os.path.basename(edr)
+    match = _EDR_LABEL.match(name)
+    if match is None:
+        return name.split(".")[0], None
+    return match.group("system"), float(match.group("T").replace("p","."))
+
+
+def batch_energy(files,n_molecules=1,gas=None,cache=None,n_workers=None,begin=0,end=None,stride=1,
+                 equilibration="auto",n_bootstrap=200,block_length=None,seed=0):
+    """
+    複数の .edr について GmxEnergy.fluctuation_properties を ProcessPoolExecutor で並列に求め、1 つの表にする。
+
+    cache を指定すると、.edr ごとの結果を内容のハッシュ・更新時刻・解析の条件をキーにして
+    cache/<キー>.json に保存し、次からは新しいファイルや変わったファイルだけを読む。
+    温度・濃度を振った計算をまとめて解析し直すときに使う。
+
+    引数:
+        files (str or list of str): .edr のパスまたは glob のパターン (のリスト)
+        n_molecules (int or dict): 系の分子数。{系: 分子数} で系ごとにも指定できる。
+        gas (float or str or dict, optional): GmxEnergy.fluctuation_properties の gas。{系: gas} も可。
+        cache (str, optional): 結果を保存するディレクトリ
+        n_workers (int, optional): プロセス数。None なら CPU 数。
+        seed (int): ブートストラップの乱数の種。同じ結果を再現できるよう既定は 0。
+        その他の引数は GmxEnergy.fluctuation_properties と同じ。
+
+    戻り値:
+        pd.DataFrame: system, T (K), property, mean, error, unit, edr の列。
+            系と温度はファイル名から取る (energy_label)。取れない温度は Temperature の平均。
+    """
+    patterns = [files] if isinstance(files,str) else list(files)
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths += [path for path in matched if path not in paths]
+    if not paths:
+        raise ValueError(f"no .edr files match {files}")
+    options = dict(begin=begin,end=end,stride=stride,equilibration=equilibration,
+                   n_bootstrap=n_bootstrap,block_length=block_length,seed=seed)
+    jobs = []
+    for path in paths:
+        system, T = energy_label(path)
+        kwargs = dict(
+            options,
+            n_molecules=n_molecules[system] if isinstance(n_molecules,dict) else n_molecules,
+            gas=gas.get(system) if isinstance(gas,dict) else gas,
+        )
+        jobs.append((path,system,T,kwargs))
+
+    def cache_key(path,kwargs):
+        # 気相の .edr を変えたときも計算し直す
+        sources = [path] + ([kwargs["gas"]] if isinstance(kwargs["gas"],str) else [])
+        meta = json.dumps(dict(
+            sources=[(file_fingerprint(source),os.stat(source).st_mtime_ns) for source in sources],**kwargs
+        ),sort_keys=True)
+        return hashlib.sha1(meta.encode()).hexdigest()
+
+    results = {}
+    missing = []
+    for path, _, _, kwargs in jobs:
+        if cache is None:
+            missing.append((path,None,kwargs))
+            continue
+        key = cache_key(path,kwargs)
+        try:
+            with open(os.path.join(cache,f"{key}.json")) as f:
+                entry = json.load(f)
+            results[path] = pd.DataFrame(entry["records"])
+            results[path].attrs.update(entry["attrs"])
+        except (OSError,ValueError,KeyError):
+            missing.append((path,key,kwargs))
+    if missing:
+        n_workers = min(n_workers or os.cpu_count() or 1,len(missing))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            computed = executor.map(_energy_worker,[(path,kwargs) for path, _, kwargs in missing])
+            for (path,key,_), result in zip(missing,computed):
+                results[path] = result
+                if cache is None:
+                    continue
+                # 書き込み中に落ちても壊れないよう一時ファイルから置き換える
+                os.makedirs(cache,exist_ok=True)
+                entry_path = os.path.join(cache,f"{key}.json")
+                with open(f"{entry_path}.{os.getpid()}.tmp","w") as f:
+                    json.dump(dict(edr=os.path.abspath(path),records=result.to_dict("records"),
+                                   attrs=result.attrs),f,indent=1,default=float)
+                os.replace(f"{entry_path}.{os.getpid()}.tmp",entry_path)
+    tables = []
+    for path, system, T, _ in jobs:
+        table = results[path][["property","mean","error","unit"]].copy()
+        table.insert(0,"T",T if T is not None else results[path].attrs["temperature"])
+        table.insert(0,"system",system)
+        table["edr"] = path
+        tables.append(table)
+    return pd.concat(tables,ignore_index=True)
+
+
+def _energy_worker(job):
+    """batch_energy の 1 ファイル分。ProcessPoolExecutor で pickle できるようモジュール関数にしている。"""
+    path, kwargs = job
+    return GmxEnergy(path).fluctuation_properties(**kwargs)
+
+
+# 原子散乱因子の Cromer-Mann 係数 [a1, b1, a2, b2, a3, b3, a4, b4, c]
+# (International Tables for Crystallography Vol. C, Table 6.1.1.4)
+ASF_TABLE = {
+    "H": [0.493002, 10.5109, 0.322912, 26.1257, 0.140191, 3.14236, 0.04081, 57.7997, 0.003038],
+    "C": [2.31, 20.8439, 1.02, 10.2075, 1.5886, 0.5687, 0.865, 51.6512, 0.2156],
+    "N": [12.2126, 0.0057, 3.1322, 9.8933, 2.0125, 28.9975, 1.1663, 0.5826, -11.529],
+    "O": [3.0485, 13.2771, 2.2868, 5.7011, 1.5463, 0.3239, 0.867, 32.9089, 0.2508],
+    "F": [3.5392, 10.2825, 2.6412, 4.2944, 1.517, 0.2615, 1.0243, 26.1476, 0.2776],
+    "P": [6.4345, 1.9067, 4.1791, 27.157, 1.78, 0.526, 1.4908, 68.1645, 1.1149],
+    "S": [6.9053, 1.4679, 5.2034, 22.2151, 1.4379, 0.2536, 1.5863, 56.172, 0.8669],
+    "Cl": [11.4604, 0.0104, 7.1964, 1.1662, 6.2556, 18.5194, 1.6455, 47.7784, -9.5574],
+    "Br": [17.1789, 2.1723, 5.2358, 16.5796, 5.6377, 0.2609, 3.9851, 41.4328, 2.9557],
+    "I": [20.1472, 4.347, 18.9949, 0.3814, 7.5138, 27.766, 2.2735, 66.8776, 4.0712],
+    # ions.itp の単原子イオン
+    "Li1+": [0.6968, 4.6237, 0.7888, 1.9557, 0.3414, 0.6316, 0.1563, 10.0953, 0.0167],
+    "Na1+": [3.2565, 2.6671, 3.9362, 6.1153, 1.3998, 0.2001, 1.0032, 14.039, 0.404],
+    "Mg2+": [3.4988, 2.1676, 3.8378, 4.7542, 1.3284, 0.185, 0.8497, 10.1411, 0.4853],
+    "K1+": [7.9578, 12.6331, 7.4917, 0.7674, 6.359, -0.002, 1.1915, 31.9128, -4.9978],
+    "Ca2+": [15.6348, -0.0074, 7.9518, 0.6089, 8.4372, 10.3116, 0.8537, 25.9905, -14.875],
+    "Zn2+": [11.9719, 2.9946, 7.3862, 0.2031, 6.4668, 7.0826, 1.394, 18.0995, 0.7807],
+    "Rb1+": [17.5816, 1.7139, 7.6598, 14.7957, 5.8981, 0.1603, 2.7817, 31.2087, 2.0782],
+    "Cs1+": [20.3524, 3.552, 19.1278, 0.3086, 10.2821, 23.7128, 0.9615, 59.4565, 3.2791],
+    "F1-": [3.6322, 5.27756, 3.51057, 14.7353, 1.26064, 0.442258, 0.940706, 47.3437, 0.653396],
+    "Cl1-": [18.2915, 0.0066, 7.2084, 1.1717, 6.5337, 19.5424, 2.3386, 60.4486, -16.378],
+    "Br1-": [17.1718, 2.2059, 6.3338, 19.3345, 5.5754, 0.2871, 3.7272, 58.1535, 3.1776],
+    "I1-": [20.2332, 4.3579, 18.997, 0.3815, 7.8069, 29.5259, 2.8868, 84.9304, 4.0714],
+}
+# 単原子の残基はイオンとして扱う
+ASF_IONS = {
+    "Li": "Li1+", "Na": "Na1+", "Mg": "Mg2+", "K": "K1+", "Ca": "Ca2+", "Zn": "Zn2+",
+    "Rb": "Rb1+", "Cs": "Cs1+", "F": "F1-", "Cl": "Cl1-", "Br": "Br1-", "I": "I1-",
+}
+
+
+def asf_key(atom):
+    """原子に対応する ASF_TABLE のキーを返す。"""
+    symbol = atom.element.symbol
+    if atom.residue.n_atoms == 1:
+        # .gro では NA, CL が N, C と推定されるので残基名からイオン種を判定する
+        name = atom.residue.name.strip("+-").capitalize()
+        if name in ASF_IONS:
+            return ASF_IONS[name]
+        if symbol in ASF_IONS:
+            return ASF_IONS[symbol]
+    return symbol
+
+
+def cromer_mann(asf_a,asf_b,asf_c,q_norm2,exp=np.exp):
+    """
+    元素ごとの原子散乱因子 f_e(|q|) = Σ_k a_k exp(-b_k |q|^2 / 16π^2) + c を計算する。
+
+    q は nm^-1、b は Å^2 単位。(E,4,M) のような一時配列を作らないよう k について足し込む。
+    exp に torch.exp を渡せば torch のテンソルにも使える。
+
+    引数:
+        asf_a, asf_b (E,4), asf_c (E,1): Cromer-Mann 係数
+        q_norm2 (..., M): |q|^2
+
+    戻り値:
+        (..., E, M) の形状因子
+    """
+    s2 = q_norm2[...,None,:] / (16 * np.pi**2 * 100)
+    f = asf_c + asf_a[:,0:1] * exp(-asf_b[:,0:1] * s2)
+    for k in range(1,asf_a.shape[1]):
+        f = f + asf_a[:,k:k+1] * exp(-asf_b[:,k:k+1] * s2)
+    return f
+
+
+def parse_memory(value):
+    """
+    "4GB", "512MB" のようなメモリ量をバイト数に変換する。数値はそのままバイト数とみなす。
+    """
+    if value is None or isinstance(value,(int,float)):
+        return value
+    units = {"KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40, "B": 1}
+    text = value.strip().upper()
+    for unit,scale in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * scale)
+    return int(float(text))
+
+
+WAXS_BACKENDS = ("numpy", "torch-cpu", "cuda")
+
+
+def select_backend(backend="auto"):
+    """
+    WAXS カーネルの計算バックエンドを決定する。
+
+    引数:
+        backend (str): "auto", "numpy", "torch-cpu", "cuda" のいずれか。
+            "auto" の場合は cuda -> torch-cpu -> numpy の順に利用可能なものを選ぶ。
+
+    戻り値:
+        str: 実際に使用するバックエンド名。
+    """
+    if backend == "auto":
+        if torch is None:
+            return "numpy"
+        if torch.cuda.is_available():
+            return "cuda"
+        return "torch-cpu"
+    if backend not in WAXS_BACKENDS:
+        raise ValueError(f"unknown backend '{backend}': choose from {WAXS_BACKENDS} or 'auto'")
+    if backend != "numpy" and torch is None:
+        raise ImportError(f"backend '{backend}' requires torch")
+    if backend == "cuda" and not torch.cuda.is_available():
+        raise RuntimeError("backend 'cuda' was requested but CUDA is not available")
+    return backend
+
+
+@lru_cache(maxsize=None)
+def make_qset(maxq_int):
+    """
+    シェル平均に使う整数 q ベクトル (2π/L 単位) の集合を作る。
+
+    |h| が最大シェル (maxq_int-1) の外側にある点は捨て、F(-q) = F(q)* なので
+    ±h の組からは半空間側の一方だけを残す。残した点の重みは 2 になる。
+
+    引数:
+        maxq_int (int): 2π/L 単位の最大 q。シェル 1, ..., maxq_int-1 を対象とする。
+
+    戻り値:
+        tuple: (hs (M,3) int, shell (M,) int, weight (M,) float)
+    """
+    g = np.arange(-maxq_int,maxq_int+1)
+    hs = np.stack(np.meshgrid(g,g,g,indexing="ij"),axis=-1).reshape(-1,3)
+    h, k, l = hs[:,0], hs[:,1], hs[:,2]
+    half = (h > 0) | ((h == 0) & (k > 0)) | ((h == 0) & (k == 0) & (l > 0))
+    shell = np.rint(np.sqrt(np.sum(hs**2,axis=1))).astype(int)
+    keep = half & (shell <= maxq_int-1)
+    hs, shell = hs[keep], shell[keep]
+    weight = np.full(len(hs),2.0)
+    for arr in (hs,shell,weight):
+        arr.setflags(write=False)
+    return hs, shell, weight
+
+
+def sample_qset(maxq_int,n_directions,method,rng):
+    """
+    make_qset(maxq_int) の各シェルから一部の q だけを選ぶ。
+
+    "random" はシェル内の格子点から重複なしに無作為に選ぶ。"fibonacci" は半球上の Fibonacci 格子
+    (ランダムに回転したもの) の各方向に最も近い格子点を選ぶので、方向がほぼ一様に散らばる。
+    ±h は同じ点として扱う。選んだ点の重みは 2 × (シェルの点数)/(選んだ点数) で、シェルごとの
+    重みの合計は make_qset と変わらない。
+
+    引数:
+        n_directions (int or np.ndarray): シェルあたりの点数。配列ならシェル番号 (0..maxq_int-1) ごと。
+        method (str): "random" または "fibonacci"
+        rng (np.random.Generator): 乱数生成器
+
+    戻り値:
+        tuple: (hs (M',3) int, shell (M',) int, weight (M',) float)
+    """
+    hs, shell, _ = make_qset(maxq_int)
+    n_directions = np.broadcast_to(n_directions,(maxq_int,))
+    keep, weights = [], []
+    for i in range(1,maxq_int):
+        pos = np.flatnonzero(shell == i)
+        n = int(n_directions[i])
+        if n >= len(pos):
+            sel = pos
+        elif method == "random":
+            sel = rng.choice(pos,n,replace=False)
+        else:
+            k = np.arange(n) + 0.5
+            z = 1 - k/n
+            phi = np.pi*(3 - np.sqrt(5))*k
+            directions = np.stack([np.sqrt(1 - z**2)*np.cos(phi),np.sqrt(1 - z**2)*np.sin(phi),z],axis=1)
+            rotation, _ = np.linalg.qr(rng.standard_normal((3,3)))
+            units = hs[pos] / np.linalg.norm(hs[pos],axis=1)[:,None]
+            sel = pos[np.unique(np.argmax(np.abs(directions @ rotation.T @ units.T),axis=1))]
+        keep.append(np.sort(sel))
+        weights.append(np.full(len(sel),2.0*len(pos)/len(sel)))
+    if len(keep) == 0:
+        return hs[:0], shell[:0], np.zeros(0)
+    keep = np.concatenate(keep)
+    return hs[keep], shell[keep], np.concatenate(weights)
+
+
+def bspline_weights(frac,order):
+    """
+    cardinal B-spline の重み M_order(frac + i) (i = 0, ..., order-1) を漸化式で求める。
+
+    引数:
+        frac (np.ndarray): 格子点からの端数 (0 <= frac < 1)
+        order (int): B-spline の次数 (2 以上)
 
-    def __init__(self,gro,trr):
+    戻り値:
+        np.ndarray: (..., order)
+    """
+    frac = np.asarray(frac,dtype=np.float64)[...,None]
+    i = np.arange(order)
+    W = np.where(i == 0,frac,np.where(i == 1,1 - frac,0.0))  # M_2
+    for n in range(3,order+1):
+        prev = np.concatenate([np.zeros_like(W[...,:1]),W[...,:-1]],axis=-1)
+        W = ((frac + i) * W + (n - frac - i) * prev) / (n - 1)
+    return W
 
+
+def fft_size(n):
+    """n 以上で素因数が 2, 3, 5 だけの最小の整数 (FFT が速いグリッドサイズ)。"""
+    size = n
+    while True:
+        m = size
+        for p in (2,3,5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return size
+        size += 1
+
+
+class WaxsCalculator:
+
+    def __init__(self,gro,trr,backend="auto",n_threads=None,kernel="direct",max_memory=None,
+                 mesh_order=6,mesh_oversample=2.0,verbose=True,metrics=None,cache=None,cache_size="10GB",
+                 q_sampling=None,n_directions=64,sampling_error=None,seed=None,prefetch=2,
+                 extract=None):
+        """
+        引数:
+            gro (str): トポロジーとして使う .gro
+            trr (str): トラジェクトリ
+            backend (str): "auto", "numpy", "torch-cpu", "cuda" のいずれか。
+                numpy と torch のどちらでも I(q) は相対誤差 1e-4 程度で一致する (float32 演算)。
+            n_threads (int, optional): CPU バックエンドで使うスレッド数。None なら全コア。
+            kernel (str): "direct" は cos/sin(q・r) を直接計算する。"separable" は格子 q の
+                exp(i q・r) を軸ごとの位相表の積で作る (calc_F_lattice)。"mesh" は原子を周期グリッドに
+                B-spline で割り当てて 3 次元 FFT する (calc_F_mesh)。q の数に依らないので高い maxq や
+                2 次元パターン (detector_pattern) に向く。
+            max_memory (int or str, optional): カーネルの作業メモリの上限 (バイト数または "4GB" など)。
+                指定すると q と原子のタイルサイズをこの範囲に収まるよう決め、実際のピークを
+                peak_memory に記録する。None の場合は従来どおり 5000 点ずつのタイルを使う。
+            mesh_order (int): mesh カーネルの B-spline の次数
+            mesh_oversample (float): mesh カーネルのグリッド点数と (2|h|max+1) の比。
+                既定の次数 6、2 倍では direct カーネルとの I(q) の相対誤差は 5e-4 程度、
+                次数 8 では 5e-5 程度 (誤差は (1/mesh_oversample)^mesh_order で減る)。
+            verbose (bool): False にするとフレームごと・シェルごとの標準出力を止める。
+            metrics (str or callable, optional): ステージごとの経過時間 (load, selection, form_factors,
+                kernel, binning, output) の出力先。パスなら JSON-lines で追記し、関数なら記録の辞書を
+                渡して呼ぶ。記録はチャンクごとの "chunk" と、mainroop / run_parallel の最後の "summary"。
+                集計は timings にも残る。キャッシュを使う場合は cache のステージも加わる。
+            cache (str, optional): フレームごとの格子 q の振幅 F を保存するディレクトリ。
+                トラジェクトリと .gro の内容、選択、カーネルが同じなら、maxq や binning、統計の
+                取り方を変えて再実行してもトラジェクトリを読まずにキャッシュから計算する
+                (maxq は以前以下であればよい)。binning="absolute" は 1 シェル外側まで使うので、
+                binning="shell" で作ったキャッシュは同じ maxq の binning="absolute" には使えず、
+                トラジェクトリを読み直す (逆は使える)。
+            cache_size (int or str): cache の上限。超えると最も長く使っていないフレームから消す。
+            q_sampling (str, optional): "random" または "fibonacci" にすると、各シェルの格子点から
+                n_directions 点だけを選んで計算する (sample_qset)。シェルの点数は半径の 2 乗で増えるので、
+                カーネルのコストがシェル数にほぼ比例するようになる。点はチャンクごとに選び直すので、
+                方向のサンプリングによるばらつきはフレーム間の標準誤差 (dy) にも含まれる。
+                推定したサンプリング誤差 (平均した I(q) のシェルごとの相対誤差) は sampling_error_
+                に残し、metrics の "summary" にも出力する。cache とは併用できない。
+            n_directions (int): シェルあたりの点数 (sampling_error を指定した場合は最初のチャンクの点数)
+            sampling_error (float, optional): 1 フレームのシェル平均の目標相対誤差。チャンクごとに
+                シェル内の |F|^2 のばらつきから次のチャンクの点数を決め直す。
+            seed (int, optional): q_sampling の乱数の種
+            prefetch (int): トラジェクトリのチャンクを別スレッドで先読みしておく数 (Prefetcher)。
+                0 なら先読みしない。load のステージは先読みが間に合わなかった待ち時間になる。
+            extract (str, optional): 縮約トラジェクトリ (extract_trajectory) を置くディレクトリ。
+                指定すると、選択した原子と stride ごとの end までのフレームだけを取り出した
+                トラジェクトリを初回に作り、以降は元のトラジェクトリの代わりにそれを読む。
+                元のファイルの内容と条件を記録しておき、条件を満たすもの (原子と時間範囲が多く、
+                stride の約数のもの) があれば自動で再利用する。
+        """
+        if q_sampling not in (None,"random","fibonacci"):
+            raise ValueError(f"unknown q_sampling '{q_sampling}': choose from 'random', 'fibonacci'")
+        if q_sampling is not None and cache is not None:
+            raise ValueError("cache stores the full lattice: it cannot be combined with q_sampling")
+        if kernel not in ("direct","separable","mesh"):
+            raise ValueError(f"unknown kernel '{kernel}': choose from 'direct', 'separable', 'mesh'")
         self.gro = gro
         self.trr = trr
+        self.topology = None
+        self._selections = {}
+        self.query_names = self.query_members = None
+        self.kernel = kernel
+        self.mesh_order = mesh_order
+        self.mesh_oversample = mesh_oversample
+        self.verbose = verbose
+        self.metrics = metrics
+        self.timings = {}
+        self.cache = cache
+        self.cache_size = parse_memory(cache_size)
+        # cache の合計サイズ。最初の cache_evict で数え、以降は cache_store で書いた分を足す
+        self._cache_total = None
+        self._fingerprints = {}
+        self.q_sampling = q_sampling
+        self.n_directions = n_directions
+        self.sampling_error = sampling_error
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.sampling_error_ = None
+        self.prefetch = prefetch
+        self.extract = extract
+        self._source = None
+        self.max_memory = parse_memory(max_memory)
+        self.peak_memory = 0
+        self._estimated_peak = 0
+        self.backend = select_backend(backend)
+        self.n_threads = n_threads if n_threads is not None else (os.cpu_count() or 1)
+        if self.backend == "torch-cpu":
+            torch.set_num_threads(self.n_threads)
+
+    @contextmanager
+    def stage(self,name):
+        """with ブロックの経過時間を timings[name] に足し込む。"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name,0.0) + time.perf_counter() - start
+
+    def emit(self,event,**fields):
+        """metrics に記録を 1 件出力する。"""
+        if self.metrics is None:
+            return
+        record = dict(event=event,pid=os.getpid(),**fields)
+        if callable(self.metrics):
+            self.metrics(record)
+        else:
+            with open(self.metrics,"a") as f:
+                f.write(json.dumps(record) + "\n")
 
-    def assign_asf(self,atoms_idx):
-
-        asf_a = {}
-        asf_b = {}
-        asf_c = {}
-        asf_a["H"] = np.array([0.493002,0.322912,0.140191,0.04081])
-        asf_b["H"] = np.array([10.5109,26.1257,3.14236,57.7997])
-        asf_c["H"] = np.array([0.003038])
-        asf_a["C"] = np.array([2.31,1.02,1.5886,0.865])
-        asf_b["C"] = np.array([20.8439,10.2075,0.5687,51.6512])
-        asf_c["C"] = np.array([0.2156])
-        data = [12.2126, 0.0057, 3.1322, 9.8933, 2.0125, 28.9975, 1.1663, 0.5826, -11.529]
-        # Reshape into arrays for a, b, c
-        asf_a["N"] = np.array(data[:-1:2])  # Elements at even indices
-        asf_b["N"] = np.array(data[1::2])  # Elements at odd indices except the last
-        asf_c["N"] = np.array([data[-1]])  # Last element
-        data = [3.0485, 13.2771, 2.2868, 5.7011, 1.5463, 0.3239, 0.867, 32.9089, 0.2508]
-        asf_a["O"] = np.array(data[:-1:2])  # Elements at even indices
-        asf_b["O"] = np.array(data[1::2])  # Elements at odd indices except the last
-        asf_c["O"] = np.array([data[-1]])  # Last element
-        trajectory = md.load(self.gro)  # 必要なファイル名に変更
-        topology = trajectory.topology
-        # 条件に基づく原子番号を取得
-        # 例: 元素が 'C' の原子番号を取得
-        self.asf_a_arr = np.stack([asf_a[atom.element.symbol] for idx,atom in enumerate(topology.atoms) if idx in atoms_idx])
-        self.asf_b_arr = np.stack([asf_b[atom.element.symbol] for idx,atom in enumerate(topology.atoms) if idx in atoms_idx])
-        self.asf_c_arr = np.stack([asf_c[atom.element.symbol] for idx,atom in enumerate(topology.atoms) if idx in atoms_idx])
+    def use_extract(self,atoms_idx,stride,end):
+        """
+        extract が指定されていれば atoms_idx の原子と stride ごとの end までのフレームを含む
+        縮約トラジェクトリを探し (無ければ作り)、以降の iterload で読む。
+
+        戻り値:
+            np.ndarray: 読み込むトラジェクトリの中での atoms_idx の位置。
+        """
+        self._source = None
+        if self.extract is None:
+            return atoms_idx
+        with self.stage("extract"):
+            # frames_before_end は時刻の整数部で比べるので、ceil(end) 未満のフレームが使われる
+            self._source = extract_trajectory(
+                self.gro,self.trr,self.extract,atoms_idx=atoms_idx,stride=stride,end=math.ceil(end)
+            )
+        self.log(f"read {self._source['trr']} instead of {self.trr}")
+        return np.searchsorted(self._source["atoms"],atoms_idx)
+
+    def iterload(self,chunk,stride,skip=0):
+        """
+        トラジェクトリを chunk フレームずつ読み込むイテレータ。prefetch > 0 なら先読みする。
+        use_extract の後は縮約トラジェクトリから読む。stride と skip はどちらも元のトラジェクトリの
+        フレーム数で数える。途中でやめる場合に備えて close() を呼ぶこと (with closing(...) など)。
+        """
+        gro, trr = self.gro, self.trr
+        if self._source is not None:
+            gro, trr = self._source["gro"], self._source["trr"]
+            first, step = self._source["first"], self._source["stride"]
+            if stride % step != 0 or skip < first or (skip - first) % step != 0:
+                raise ValueError(f"frames (skip {skip}, stride {stride}) are not in {trr}")
+            skip, stride = (skip - first)//step, stride//step
+        if skip > 0:
+            # 範囲外への seek はエラーになる
+            with md.open(trr) as f:
+                if skip >= len(f):
+                    return (chunk for chunk in ())
+        frames = md.iterload(trr,top=gro,chunk=chunk,stride=stride,skip=skip)
+        if self.prefetch > 0:
+            return Prefetcher(frames,depth=self.prefetch)
+        return frames
+
+    def log(self,*args):
+        if self.verbose:
+            print(*args,flush=True)
+
+    def assign_asf(self,atoms_idx,topology=None,groups=None,group_labels=None):
+        """
+        選択した原子の Cromer-Mann 係数を元素単位で設定する。
+
+        係数は元素ごとに (E,4) の配列で持つ。原子は (元素, 部分構造因子のグループ) の組
+        ごとに成分へまとめ、各原子には成分番号 asf_group を割り当てる。
+
+        引数:
+            atoms_idx (np.ndarray): 対象原子のインデックス。
+            topology (md.Topology, optional): None の場合は self.gro から読み込む。
+            groups (str, optional): 部分構造因子のグループ分け。"element" または "resname"。
+                None の場合はすべての原子を 1 グループとして扱う。
+            group_labels (array-like, optional): 原子ごとのグループ名。指定すると groups より優先する。
+        """
+        if topology is None:
+            topology = md.load_topology(self.gro)
+        keys = [asf_key(topology.atom(idx)) for idx in atoms_idx]
+        self.asf_elements, element_idx = np.unique(keys,return_inverse=True)
+        if group_labels is not None:
+            self.group_names, group_idx = np.unique(group_labels,return_inverse=True)
+        elif groups is None:
+            self.group_names = np.array(["all"])
+            group_idx = np.zeros(len(atoms_idx),dtype=int)
+        elif groups == "element":
+            self.group_names, group_idx = self.asf_elements, element_idx
+        elif groups == "resname":
+            self.group_names, group_idx = np.unique(
+                [topology.atom(idx).residue.name for idx in atoms_idx],return_inverse=True
+            )
+        else:
+            raise ValueError(f"unknown groups '{groups}': choose from 'element', 'resname'")
+        components, self.asf_group = np.unique(
+            np.stack([element_idx,group_idx],axis=1).reshape(-1,2),axis=0,return_inverse=True
+        )
+        self.asf_group = self.asf_group.reshape(-1)
+        self.asf_component_element = components[:,0]
+        self.asf_component_group = components[:,1]
+        missing = [e for e in self.asf_elements if e not in ASF_TABLE]
+        if missing:
+            raise KeyError(f"no atomic scattering factor for {missing}: add them to ASF_TABLE")
+        coeffs = np.array([ASF_TABLE[e] for e in self.asf_elements])  # (E,9)
+        self.asf_a_arr = coeffs[:,0:8:2]
+        self.asf_b_arr = coeffs[:,1:8:2]
+        self.asf_c_arr = coeffs[:,8:9]
+
+    def get_idx(self,topology : md.Topology,query):
+
+        if query == "water":
+            return self.get_water_idx(topology=topology)
+        elif query == "MOL":
+            return self.get_MOL_idx(topology=topology)
+        elif query == "all":
+            return self.get_all_idx(topology=topology)
+        raise ValueError(f"unknown query '{query}': choose from 'water', 'MOL', 'all'")
+
+    def select(self,query,groups=None):
+        """
+        query の原子選択と形状因子係数を求める。
+
+        どちらもトポロジーだけで決まるので、トラジェクトリごとに一度だけ計算してキャッシュする。
+        query に ("all","MOL","water") のような複数の選択を渡すと、それらの和集合を
+        どの選択に含まれるかで互いに素な領域に分け、領域をグループとして扱う。
+        各選択の F(q) は含まれる領域の F の和になる (query_members)。
+
+        戻り値:
+            np.ndarray: 対象原子のインデックス。
+        """
+        attrs = (
+            "asf_elements","asf_group","asf_component_element","asf_component_group",
+            "group_names","asf_a_arr","asf_b_arr","asf_c_arr","query_names","query_members"
+        )
+        if isinstance(query,list):
+            query = tuple(query)
+        if (query,groups) not in self._selections:
+            if self.topology is None:
+                self.topology = md.load_topology(self.gro)
+            if isinstance(query,tuple):
+                if groups is not None:
+                    raise ValueError("groups cannot be combined with multiple queries")
+                selections = [self.get_idx(self.topology,q) for q in query]
+                atoms_idx = np.unique(np.concatenate(selections))
+                members = np.stack([np.isin(atoms_idx,idx) for idx in selections])  # (Q,N)
+                labels = ["+".join(q for q,m in zip(query,col) if m) for col in members.T]
+                self.assign_asf(atoms_idx,topology=self.topology,group_labels=labels)
+                self.query_names = list(query)
+                self.query_members = np.array(
+                    [[q in label.split("+") for label in self.group_names] for q in query],dtype=float
+                )  # (Q,G)
+            else:
+                atoms_idx = self.get_idx(self.topology,query)
+                self.assign_asf(atoms_idx,topology=self.topology,groups=groups)
+                self.query_names = self.query_members = None
+            self._selections[query,groups] = (atoms_idx,{name: getattr(self,name) for name in attrs})
+        atoms_idx, cached = self._selections[query,groups]
+        for name in attrs:
+            setattr(self,name,cached[name])
+        return atoms_idx
+
+    def pair_names(self):
+        """部分構造因子 S_ab(q) の列名 (a <= b) を返す。"""
+        names = self.group_names
+        return [f"{names[a]}-{names[b]}" for a in range(len(names)) for b in range(a,len(names))]
 
     def get_water_idx(self,topology : md.Topology):
 
@@ -85,127 +711,1484 @@ class WaxsCalculator:
         return topology.select("(symbol != VS) and all")
 
 
-    def mainroop(self,name,query="water",maxq=35,stride=10,end=1000):
-        frame : md.Trajectory
-        print("begin to calculation")
-        count = 0
-        Iq_save_list = []
-        for frame  in md.iterload(self.trr,top=self.gro,chunk=1,stride=stride):
-            count += 1
+    def mainroop(self,name,query="water",maxq=35,stride=10,end=1000,frames_per_batch=1,
+                 checkpoint=None,checkpoint_interval=100,groups=None,block_size=None,timeseries=None,
+                 binning="shell",dq=None):
+        """
+        WAXS プロファイル I(q) をトラジェクトリ平均して .xvg に書き出す。
+
+        引数:
+            name (str): 出力ファイル名の接尾辞 (<trr>_<name>.xvg)
+            query (str or tuple): "water", "MOL", "all" のいずれか。("all","MOL","water") のように
+                複数渡すと、トラジェクトリの読み込みと位相の計算を共有して 1 回のパスで
+                各選択の I(q) を計算し、選択名の列として書き出す。"all" と "water" を含む場合は
+                溶媒を差し引いた excess = I_all - I_water の列も加える。
+            maxq (float): 最大 q (nm^-1)
+            stride (int): 読み込むフレームの間隔
+            end (float): この時刻 (ps) 以降のフレームは使わない
+            frames_per_batch (int): まとめて読み込み、一度のカーネル呼び出しで評価するフレーム数
+            checkpoint (str, optional): 途中経過を保存する .npz。同じ引数で再実行するとそこから再開する。
+            checkpoint_interval (int): checkpoint を書き出すフレーム間隔
+            groups (str, optional): "element" または "resname" を指定すると、同じパスで
+                グループ間の部分構造因子 S_ab(q) = <Re F_a(q) F_b(q)*> も計算し、
+                全体の I(q) (y 列) の後ろに a-b 列として書き出す。
+                I(q) = Σ_a S_aa + 2 Σ_{a<b} S_ab となる。
+            block_size (int, optional): 標準誤差をこのフレーム数のブロック平均から求める。
+                None の場合はフレームを独立とみなした標準誤差になる。
+            timeseries (str, optional): フレームごとの I(q) を書き出す .npy (memmap)。
+                形状は (フレーム数, 列数, q 点数)、時刻は <timeseries>_time.npy に入る。
+            binning (str): "shell" はフレームごとに 2π/L 単位のシェルで平均し、0..maxq の 100 点に
+                3 次補間してから平均する。"absolute" は |F(q)|^2 を幅 dq の固定した絶対 q のビンに
+                直接足し込み、ビンごとの q 点数で割る (NPT でも補間が要らない)。ビンは dq の整数倍を
+                中心とし、出力はビン中心で、q 点の無いビンは書き出さず、count 列にビンごとの q 点数
+                (全フレームの合計) を置く。
+            dq (float, optional): binning="absolute" のビン幅 (nm^-1)。None なら .gro の箱の 2π/L。
+        """
+        self.log("begin to calculation")
+        self.timings = {}
+        starttime = time.perf_counter()
+        with self.stage("selection"):
+            self.select(query,groups)
+        if binning == "absolute" and dq is None:
+            dq = self.default_dq()
+        if timeseries is not None:
+            self.open_timeseries(
+                timeseries,stride,len(self.profile_labels(groups)),self.n_points(maxq,binning,dq),create=True
+            )
+        acc = self.accumulate(
+            query=query,maxq=maxq,stride=stride,end=end,frames_per_batch=frames_per_batch,
+            checkpoint=checkpoint,checkpoint_interval=checkpoint_interval,groups=groups,
+            block_size=block_size,timeseries=timeseries,binning=binning,dq=dq
+        )
+        if acc.count == 0:
+            raise ValueError(f"no frames before {end} ps in {self.trr}")
+        with self.stage("output"):
+            self.write_profile(name,maxq,acc,groups,binning,dq)
+        self.emit(
+            "summary",frames=acc.count,seconds=time.perf_counter()-starttime,stages=dict(self.timings),
+            **self.sampling_summary()
+        )
+
+    def run_parallel(self,name,n_workers=None,query="water",maxq=35,stride=10,end=1000,frames_per_batch=1,
+                     checkpoint=None,checkpoint_interval=100,groups=None,block_size=None,timeseries=None,
+                     binning="shell",dq=None):
+        """
+        トラジェクトリをフレーム範囲に分割し、ProcessPoolExecutor で並列に mainroop と同じ計算を行う。
+
+        各プロセスの ProfileAccumulator をまとめて平均し、mainroop と同じ .xvg に書き出す。
+        ブロック平均は各フレーム範囲の中で作るので、範囲の末尾の半端なブロックは誤差の見積もりに使わない。
+
+        引数:
+            n_workers (int, optional): プロセス数。None なら CPU コア数。
+            checkpoint (str, optional): 指定するとプロセスごとに <checkpoint>_<k>.npz を保存する。
+            その他の引数は mainroop と同じ。
+        """
+        n_workers = n_workers or os.cpu_count() or 1
+        with md.open(self.trr) as f:
+            n_total = len(f)
+            times = f.read(n_frames=2)[1]
+        if len(times) == 2 and times[1] > times[0]:
+            # end 以降のフレームは使わない (frames_before_end と同じく時刻の整数部で比べる)。
+            # 時刻は先頭 2 フレームの間隔から求め、丸め誤差で境界のフレームを落とさないよう少し手前にずらす
+            dt = float(times[1] - times[0])
+            frame_times = times[0] + np.arange(n_total)*dt
+            n_total = int(np.sum(np.floor(frame_times - 1e-6*dt) < end))
+        # stride 後のフレーム番号を連続した範囲に分ける
+        frame_ids = np.arange(0,n_total,stride)
+        if len(frame_ids) == 0:
+            raise ValueError(f"no frames before {end} ps in {self.trr}")
+        ranges = [ids for ids in np.array_split(frame_ids,n_workers) if len(ids) > 0]
+        # プロセス間でスレッドを奪い合わないようにする
+        n_threads = max(1,self.n_threads//len(ranges))
+        self.log("begin to calculation")
+        self.timings = {}
+        starttime = time.perf_counter()
+        with self.stage("selection"):
+            atoms_idx = self.select(query,groups)
+        # 縮約トラジェクトリは各プロセスが同時に作らないよう先に作っておく
+        self.use_extract(atoms_idx,stride,end)
+        if binning == "absolute" and dq is None:
+            dq = self.default_dq()
+        if timeseries is not None:
+            # 各プロセスは同じファイルの自分の行だけに書き込む
+            self.open_timeseries(
+                timeseries,stride,len(self.profile_labels(groups)),self.n_points(maxq,binning,dq),create=True
+            )
+        jobs = []
+        for k,ids in enumerate(ranges):
+            part_checkpoint = None
+            if checkpoint is not None:
+                root, ext = os.path.splitext(checkpoint)
+                part_checkpoint = f"{root}_{k}{ext or '.npz'}"
+            jobs.append(
+                (self.gro,self.trr,dict(backend=self.backend,n_threads=n_threads,kernel=self.kernel,
+                                        max_memory=self.max_memory,mesh_order=self.mesh_order,
+                                        mesh_oversample=self.mesh_oversample,verbose=self.verbose,
+                                        # 関数は別プロセスに渡せないのでファイルの場合だけ引き継ぐ
+                                        metrics=self.metrics if isinstance(self.metrics,str) else None,
+                                        cache=self.cache,cache_size=self.cache_size,
+                                        q_sampling=self.q_sampling,n_directions=self.n_directions,
+                                        sampling_error=self.sampling_error,
+                                        seed=None if self.seed is None else self.seed + k,
+                                        prefetch=self.prefetch,extract=self.extract),
+                 dict(query=query,maxq=maxq,stride=stride,end=end,frames_per_batch=frames_per_batch,
+                      skip=int(ids[0]),n_max=len(ids),
+                      checkpoint=part_checkpoint,checkpoint_interval=checkpoint_interval,groups=groups,
+                      block_size=block_size,timeseries=timeseries,binning=binning,dq=dq))
+            )
+        acc = ProfileAccumulator(
+            (len(self.profile_labels(groups)),self.n_points(maxq,binning,dq)),block_size=block_size
+        )
+        states = []
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            for part, state in executor.map(_waxs_worker,jobs):
+                acc.merge(part)
+                states.append(state)
+        # 各プロセスのサンプリング誤差の積算を合わせて、全フレームの平均の誤差にする
+        self._sampling_state = self.merge_sampling_states(states)
+        self.sampling_error_ = (
+            None if self._sampling_state is None else self.sampling_error_from_state(self._sampling_state)
+        )
+        if acc.count == 0:
+            raise ValueError(f"no frames before {end} ps in {self.trr}")
+        with self.stage("output"):
+            self.write_profile(name,maxq,acc,groups,binning,dq)
+        self.emit(
+            "summary",frames=acc.count,seconds=time.perf_counter()-starttime,
+            stages=dict(self.timings),workers=len(ranges),**self.sampling_summary()
+        )
+
+    def debye(self,name,query="MOL",maxq=35,q=None,stride=10,end=1000,frames_per_batch=1,dr=0.001,block_size=None):
+        """
+        Debye の式 I(q) = Σ_i Σ_j f_i f_j sin(q r_ij)/(q r_ij) で I(q) をトラジェクトリ平均し、.xvg に書き出す。
+
+        原子対の距離 (最小イメージ規約) を元素の組ごとに幅 dr のヒストグラムにまとめてから
+        q について和をとるので、コストは O(N^2 + 元素の組 × ビン数 × q 点数) になり、q の格子にも
+        2π/L の分解能にも縛られない。数千原子以下の選択 (query="MOL" など) で calc_F より速い。
+        q が 2π/L 程度より小さい領域は箱の大きさの影響を受ける。水のように箱全体に広がる
+        選択では最小イメージでの打ち切りが振動を生むので、mainroop を使う。計算は numpy で行う。
+
+        引数:
+            q (array-like, optional): I(q) を求める q (nm^-1)。None なら mainroop と同じ 0..maxq の 100 点。
+            dr (float): 距離のヒストグラムのビン幅 (nm)。誤差はおよそ (q dr)^2/24。
+            その他の引数は mainroop と同じ。
+
+        戻り値:
+            ProfileAccumulator: mean は (1,q 点数)
+        """
+        chunk : md.Trajectory
+        if isinstance(query,(tuple,list)):
+            raise ValueError("debye takes a single query")
+        self.log("begin to calculation")
+        self.timings = {}
+        starttime = time.perf_counter()
+        q = np.linspace(0,maxq,100) if q is None else np.asarray(q,dtype=np.float64)
+        with self.stage("selection"):
+            atoms_idx = self.select(query)
+        atoms_idx = self.use_extract(atoms_idx,stride,end)
+        element = self.asf_component_element[self.asf_group]  # 原子ごとの元素番号
+        n_elements = len(self.asf_elements)
+        with self.stage("form_factors"):
+            f = cromer_mann(self.asf_a_arr,self.asf_b_arr,self.asf_c_arr,q**2)  # (E,Q)
+            # 自己項 Σ_a N_a f_a^2
+            self_term = np.bincount(element,minlength=n_elements) @ f**2  # (Q,)
+        acc = ProfileAccumulator((1,len(q)),block_size=block_size)
+        sinc = np.zeros((0,len(q)))
+        with closing(self.iterload(frames_per_batch,stride)) as frames:
+            while True:
+                with self.stage("load"):
+                    chunk = next(frames,None)
+                if chunk is None:
+                    break
+                use = np.flatnonzero(chunk.time < end)
+                for t in use:
+                    self.log(f"Frame number {chunk.time[t]}")
+                    box = chunk.unitcell_lengths[t].astype(np.float64)
+                    with self.stage("kernel"):
+                        hist, n_bins = self.pair_histogram(chunk.xyz[t,atoms_idx].astype(np.float64),element,box,dr)
+                    with self.stage("binning"):
+                        if len(sinc) != n_bins:
+                            r = (np.arange(n_bins) + 0.5) * dr
+                            sinc = np.sinc(np.outer(r,q) / np.pi)  # (R,Q) sin(qr)/(qr)
+                        # Σ_{a,b} f_a f_b Σ_r H_ab(r) sinc(q r)、H_ab は i < j の対だけ数えているので 2 倍する
+                        cross = np.einsum("aq,bq,abq->q",f,f,hist @ sinc)
+                        Iq = (self_term + 2*cross) / (np.prod(box)*10**(-21)) * (2.818e-13)**2
+                        acc.add(Iq[None,:])
+                if len(use) < len(chunk):
+                    break
+        with self.stage("output"):
+            self.write_xvg(name,maxq,acc.mean,err=acc.stderr(),x=q)
+        self.emit("summary",frames=acc.count,seconds=time.perf_counter()-starttime,stages=dict(self.timings))
+        return acc
+
+    def pair_histogram(self,coords,element,box,dr):
+        """
+        原子対 (i < j) の最小イメージ距離を元素の組 (a,b) ごとのヒストグラム H_ab(r) にする。
+
+        原子をブロックに分け、ブロックと残りの原子の距離をまとめて計算する。ブロックはスレッドに
+        分配し、全スレッドの一時配列が max_memory (なければ 128MB) に収まるように大きさを決める。
+
+        戻り値:
+            tuple: (ヒストグラム (E,E,ビン数), ビン数)
+        """
+        n_atoms = len(coords)
+        n_elements = len(self.asf_elements)
+        r_max = 0.5 * np.sqrt(np.sum(box**2))
+        n_bins = int(r_max/dr) + 1
+        budget = self.max_memory if self.max_memory is not None else 2**27
+        # (B, N) の距離・差分・丸めの一時配列とビン番号。スレッドごとに 1 ブロック
+        block = max(1,int(budget / (max(n_atoms,1)*(4*3 + 8*2)*self.n_threads)))
+        # スレッドに行きわたるようブロックを分ける
+        block = min(block,-(-n_atoms//(4*self.n_threads)) or 1)
+        hist = np.zeros(n_elements*n_elements*n_bins)
+        # 軸ごとに連続した配列にしておき、(B,N') の 2 次元配列だけで距離を作る
+        xyz = np.ascontiguousarray(np.asarray(coords,dtype=np.float32).T)  # (3,N)
+        box = np.asarray(box,dtype=np.float32)
+
+        def _add(rows,cols,mask=None):
+            r2 = np.zeros((len(rows),len(xyz[0][cols])),dtype=np.float32)
+            for axis in range(3):
+                d = xyz[axis][rows,None] - xyz[axis][None,cols]
+                d -= box[axis] * np.rint(d * (1/box[axis]))
+                d *= d
+                r2 += d
+            del d
+            np.sqrt(r2,out=r2)
+            r2 *= 1/dr
+            bins = r2.astype(np.int64)
+            del r2
+            bins += (element[rows,None] * n_elements + element[None,cols]) * n_bins
+            return np.bincount(bins[mask] if mask is not None else bins.ravel(),minlength=len(hist))
+
+        def _block(i0):
+            i1 = min(i0+block,n_atoms)
+            # ブロック内は i < j の上三角だけ、ブロックより後ろの原子とはすべての対を数える
+            diag = np.arange(i0,i1)
+            part = _add(diag,diag,np.triu(np.ones((i1-i0,i1-i0),dtype=bool),k=1))
+            if i1 < n_atoms:
+                part += _add(diag,slice(i1,None))
+            return part
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for part in executor.map(_block,range(0,n_atoms,block)):
+                hist += part
+        return hist.reshape(n_elements,n_elements,n_bins), n_bins
+
+    def accumulate(self,query="water",maxq=35,stride=10,end=1000,frames_per_batch=1,skip=0,n_max=None,
+                   checkpoint=None,checkpoint_interval=100,groups=None,block_size=None,timeseries=None,
+                   binning="shell",dq=None):
+        """
+        フレームごとの I(q) (共通の q グリッドに補間したもの、または絶対 q のビン) の平均と分散を逐次的に求める。
+
+        引数:
+            skip (int): 読み飛ばす先頭フレーム数 (stride 適用前、stride の倍数)
+            n_max (int, optional): 処理する最大フレーム数 (stride 適用後)
+            その他の引数は mainroop と同じ。
+
+        戻り値:
+            ProfileAccumulator: mean は (K,q 点数)。0 行目が全体の I(q)、
+                groups を指定した場合は続く行が pair_names() 順の S_ab(q)。
+                複数の query の場合は profile_labels() 順の各選択の I(q) と excess。
+                binning="absolute" の weight はビンごとの q 点数。
+        """
+        if binning not in ("shell","absolute"):
+            raise ValueError(f"unknown binning '{binning}': choose from 'shell', 'absolute'")
+        if binning == "absolute" and dq is None:
+            dq = self.default_dq()
+        with self.stage("selection"):
+            atoms_idx = self.select(query,groups)
+        atoms_idx = self.use_extract(atoms_idx,stride,end)
+        n_labels = len(self.profile_labels(groups))
+        n_points = self.n_points(maxq,binning,dq)
+        acc = ProfileAccumulator((n_labels,n_points),block_size=block_size)
+        last_time = None
+        # 結果を変える引数だけを checkpoint の照合に使う
+        meta = json.dumps(dict(
+            gro=os.path.abspath(self.gro),trr=os.path.abspath(self.trr),query=query,
+            maxq=maxq,stride=stride,end=end,skip=skip,n_max=n_max,groups=groups,block_size=block_size,
+            binning=binning,dq=dq,q_sampling=self.q_sampling,n_directions=self.n_directions,
+            sampling_error=self.sampling_error
+        ),sort_keys=True)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            state = self.load_checkpoint(checkpoint,meta)
+            if state is not None:
+                acc, last_time, finished = state
+                self.log(f"resume from {checkpoint}: {acc.count} frames, last time {last_time}")
+                if finished:
+                    return acc
+        if n_max is not None and acc.count >= n_max:
+            return acc
+        series = series_time = None
+        if timeseries is not None:
+            series, series_time = self.open_timeseries(timeseries,stride,n_labels,n_points)
+        saved_count = acc.count
+        self._sampling_state = None
+        multi = self.query_members is not None
+        partial = groups is not None or multi
+        # 絶対 q のビンは maxq まで埋めるので 1 シェル外側まで含める
+        chunks = self.iter_amplitudes(
+            query,groups,atoms_idx,partial,maxq,stride,end,frames_per_batch,
+            skip=skip+acc.count*stride,n_max=None if n_max is None else n_max-acc.count,
+            extra_shell=binning == "absolute"
+        )
+        while True:
+            before = dict(self.timings)
             starttime = time.time()
-            print(f"Frame number {frame.time[0]}",flush=True)
-            print(frame.time[0],end,int(frame.time[0]) >= end)
-            if int(frame.time[0]) >= end:
-                print("END")
+            item = next(chunks,None)
+            if item is None:
                 break
-            topology = frame.topology
-            atoms_idx = None
-            if query == "water":
-                atoms_idx = self.get_water_idx(topology=topology)
-            elif query == "MOL":
-                atoms_idx = self.get_MOL_idx(topology=topology)
-            elif query == "all":
-                atoms_idx = self.get_all_idx(topology=topology)
-            coords = frame.xyz[0,atoms_idx,:]
-            L = frame.unitcell_lengths[0,0]
-            maxq_int = int(maxq/(2*np.pi/L))
-            qs = np.array([[i,j,k] 
-                  for i in np.arange(-maxq_int,maxq_int+1) 
-                  for j in np.arange(-maxq_int,maxq_int+1) 
-                  for k in np.arange(-maxq_int,maxq_int+1)],dtype=np.float32)
-            qs *= 2*np.pi/L
-            self.assign_asf(atoms_idx)
-            F=self.calc_F(qs,coords)
-            q_norm = np.linalg.norm(qs,axis=1)
-            q_id = q_norm / (2*np.pi/L)
-            Iqs = []
-            for i in range(1,maxq_int):
-                F_selected = F[(q_id>=i-0.5) & (q_id<i+0.5)]
-                Iq = np.mean(np.abs(F_selected)**2)
-                Iq /= (L*10**(-7))**3
-                Iq *= (2.818e-13)**2
-                Iqs.append(Iq)
-                print(i*2*np.pi/L,Iq)
-            Iq = np.array(Iqs)
-            waxs_interp = interp1d(
-                x=2*np.pi/L*np.arange(1,maxq_int),
-                y=Iq,kind="cubic",fill_value="extrapolate"
+            times, Ls, (hs, shell, weight), F, reached_end = item
+            n_frames = len(times)
+            if n_frames > 0:
+                maxq_ints = (maxq/(2*np.pi/Ls)).astype(int)
+                for t in range(n_frames):
+                    with self.stage("binning"):
+                        if multi:
+                            intensity = self.query_intensities(F[t])
+                        elif partial:
+                            intensity = self.pair_intensities(F[t])
+                        else:
+                            intensity = np.abs(F[t])**2
+                        if binning == "absolute":
+                            Iq, n_q = self.absolute_bin_average(intensity,hs,weight,Ls[t],dq,n_points)
+                        else:
+                            Iq = self.shell_average(intensity,shell,weight,maxq_ints[t],Ls[t],verbose=self.verbose)
+                            waxs_interp = interp1d(
+                                x=2*np.pi/Ls[t]*np.arange(1,maxq_ints[t]),
+                                y=Iq,kind="cubic",fill_value="extrapolate",axis=-1
+                            )
+                            Iq = waxs_interp(np.linspace(0,maxq,100))
+                            n_q = None
+                        Iq = np.atleast_2d(Iq)
+                        if series is not None:
+                            row = skip//stride + acc.count
+                            series[row] = Iq
+                            series_time[row] = times[t]
+                        acc.add(Iq,n_q)
+                if self.q_sampling is not None:
+                    self.update_sampling(F,shell,weight,Ls,partial,multi)
+                last_time = float(times[n_frames-1])
+            endtime = time.time()
+            self.log(f"{endtime-starttime:.2f} second")
+            self.emit(
+                "chunk",frames=n_frames,time=last_time,seconds=endtime-starttime,
+                stages={k: v - before.get(k,0.0) for k,v in self.timings.items() if v != before.get(k)}
             )
-            Iq_save_list.append(
-                waxs_interp(np.linspace(0,maxq,100))
+            if reached_end or (n_max is not None and acc.count >= n_max):
+                break
+            if checkpoint is not None and acc.count - saved_count >= checkpoint_interval:
+                with self.stage("output"):
+                    if series is not None:
+                        series.flush()
+                        series_time.flush()
+                    self.save_checkpoint(checkpoint,meta,acc,last_time,finished=False)
+                saved_count = acc.count
+        with self.stage("output"):
+            if series is not None:
+                series.flush()
+                series_time.flush()
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint,meta,acc,last_time,finished=True)
+        if self.max_memory is not None:
+            self.log(f"peak kernel memory {self.peak_memory/2**20:.1f} MiB (max_memory {self.max_memory/2**20:.1f} MiB)")
+        return acc
+
+    def iter_amplitudes(self,query,groups,atoms_idx,partial,maxq,stride,end,frames_per_batch,
+                        skip=0,n_max=None,extra_shell=False):
+        """
+        frames_per_batch フレームずつ、時刻・箱の長さと格子 q の振幅 F を返すジェネレータ。
+
+        NPT では L がフレームごとに違うので、チャンク内で最大の q 集合 make_qset(m) を共有する。
+        cache がある場合、チャンクのフレームがすべてキャッシュにあればトラジェクトリを読まずに
+        返し、そうでなければトラジェクトリから計算してキャッシュに書き込む。
+
+        引数:
+            extra_shell (bool): q 集合を 1 シェル外側まで含める
+            その他の引数は accumulate と同じ。
+
+        yield:
+            tuple: (times (T,), Ls (T,), (hs, shell, weight), F (T,[G,]M), reached_end)
+                q 集合は make_qset(m) (q_sampling の場合は sample_qset(m,...))。
+                reached_end は end 以降のフレームに達して打ち切ったかどうか。
+        """
+        chunk : md.Trajectory
+        key = self.cache_key(query,groups) if self.cache is not None else None
+        frame = skip  # stride 適用前のフレーム番号
+        count = 0
+        frames = None
+        try:
+            while n_max is None or count < n_max:
+                n_want = frames_per_batch if n_max is None else min(frames_per_batch,n_max-count)
+                entries = None
+                if key is not None:
+                    with self.stage("cache"):
+                        entries = []
+                        for k in range(n_want):
+                            entries.append(self.cache_load(key,frame + k*stride))
+                            # end 以降の最初のフレームは時刻だけの印 (m = -1) として保存してある
+                            if entries[-1] is None or int(entries[-1]["m"]) < 0:
+                                break
+                    if any(entry is None for entry in entries):
+                        entries = None
+                if entries is not None:
+                    times = np.array([entry["time"] for entry in entries])
+                    Ls = np.array([entry["L"] for entry in entries])
+                    n_frames = self.frames_before_end(times,end)
+                    m = int((maxq/(2*np.pi/Ls[:n_frames])).astype(int).max()) + extra_shell if n_frames > 0 else 0
+                    if all(int(entry["m"]) >= m for entry in entries[:n_frames]):
+                        F = None
+                        qset = make_qset(m)
+                        if n_frames > 0:
+                            with self.stage("cache"):
+                                F = np.stack([self.cache_subset(entry,m) for entry in entries[:n_frames]])
+                        # トラジェクトリの読み込み位置がずれるので、次に読むときは開き直す
+                        if frames is not None:
+                            frames.close()
+                        frames = None
+                    else:
+                        entries = None
+                if entries is None:
+                    if frames is None:
+                        frames = self.iterload(frames_per_batch,stride,skip=frame)
+                    with self.stage("load"):
+                        chunk = next(frames,None)
+                    if chunk is None:
+                        return
+                    chunk = chunk[:n_want]
+                    times = chunk.time
+                    Ls = chunk.unitcell_lengths[:,0]
+                    n_frames = self.frames_before_end(times,end)
+                    F = None
+                    qset = make_qset(0)
+                    if n_frames > 0:
+                        m = int((maxq/(2*np.pi/Ls[:n_frames])).astype(int).max()) + extra_shell
+                        if self.q_sampling is None:
+                            qset = make_qset(m)
+                        else:
+                            qset = sample_qset(m,self.shell_directions(m),self.q_sampling,self.rng)
+                        F = self.calc_F_hkl(qset[0],chunk.xyz[:n_frames][:,atoms_idx,:],Ls[:n_frames],partial=partial)
+                        if key is not None:
+                            with self.stage("cache"):
+                                for t in range(n_frames):
+                                    self.cache_store(key,frame + t*stride,times[t],Ls[t],m,F[t])
+                                self.cache_evict()
+                    if key is not None and n_frames < len(times):
+                        with self.stage("cache"):
+                            self.cache_store(key,frame + n_frames*stride,times[n_frames],Ls[n_frames],-1,np.zeros(0))
+                yield times[:n_frames], Ls[:n_frames], qset, F, n_frames < len(times)
+                if n_frames < len(times):
+                    return
+                frame += len(times)*stride
+                count += len(times)
+        finally:
+            # 途中で打ち切られた場合も先読みのスレッドとファイルを閉じる
+            if frames is not None:
+                frames.close()
+
+    def shell_directions(self,m):
+        """q_sampling で各シェル (0..m-1) から選ぶ点数。"""
+        state = getattr(self,"_sampling_state",None)
+        if self.sampling_error is None or state is None or "n_next" not in state:
+            return np.full(m,self.n_directions)
+        n_next = state["n_next"]
+        n = np.full(m,self.n_directions)
+        n[:min(m,len(n_next))] = n_next[:m]
+        return n
+
+    def update_sampling(self,F,shell,weight,Ls,partial,multi):
+        """
+        選んだ点での |F|^2 のシェル内のばらつきから、シェル平均のサンプリング誤差を見積もる。
+
+        1 フレームのシェル平均の相対分散は var/(n mean^2) × (1 - n/N) (N はシェルの全点数)。
+        チャンクごとに選び直すので、平均した I(q) の相対誤差はその平均をフレーム数で割った平方根になる。
+        sampling_error を指定した場合は、次のチャンクの点数を目標に合わせて決め直す。
+        """
+        if multi:
+            F = (self.query_members.astype(F.real.dtype) @ F)[:,0]
+        elif partial:
+            F = np.sum(F,axis=1)
+        intensity = np.abs(F)**2  # (T,M) 全体の |F|^2
+        n_shell = int(shell.max()) + 1 if len(shell) > 0 else 1
+        n = np.bincount(shell,minlength=n_shell).astype(float)
+        # 重み = 2 N / n なので、シェルの全点数 N は重みから戻せる
+        N = np.bincount(shell,weights=weight,minlength=n_shell) / 2
+        mean = np.stack([np.bincount(shell,weights=row,minlength=n_shell) for row in intensity]) / np.maximum(n,1)
+        square = np.stack([np.bincount(shell,weights=row**2,minlength=n_shell) for row in intensity]) / np.maximum(n,1)
+        var = np.maximum(square - mean**2,0) * n / np.maximum(n - 1,1)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            rel_var = np.where(n > 1,var / (n * mean**2) * (1 - n/np.maximum(N,1)),np.nan)  # (T,n_shell)
+            ratio = var / mean**2
+            cv2 = np.nansum(ratio,axis=0) / np.maximum(np.sum(np.isfinite(ratio),axis=0),1)
+            cv2[np.sum(np.isfinite(ratio),axis=0) == 0] = np.nan
+        state = self._sampling_state or dict(sum=np.zeros(0),count=np.zeros(0),frames=0,L=0.0)
+        size = max(len(state["sum"]),n_shell)
+        total, count = np.zeros(size), np.zeros(size)
+        total[:len(state["sum"])] = state["sum"]
+        count[:len(state["count"])] = state["count"]
+        total[:n_shell] += np.nansum(rel_var,axis=0)
+        count[:n_shell] += np.sum(np.isfinite(rel_var),axis=0)
+        state.update(sum=total,count=count,frames=state["frames"] + len(intensity),L=state["L"] + float(np.sum(Ls)))
+        if self.sampling_error is not None:
+            n_next = np.ceil(np.nan_to_num(cv2,nan=1.0) / self.sampling_error**2)
+            state["n_next"] = np.clip(n_next,8,None).astype(int)
+        self._sampling_state = state
+        self.sampling_error_ = self.sampling_error_from_state(state)
+
+    @staticmethod
+    def sampling_error_from_state(state):
+        """update_sampling の積算 state から (シェルの q, 平均した I(q) の相対誤差) を求める。"""
+        with np.errstate(divide="ignore",invalid="ignore"):
+            # 平均した I(q) の相対誤差 (フレームごとに独立に選んだとみなす)
+            error = np.sqrt(state["sum"] / state["count"] / np.maximum(state["count"],1))
+        return np.arange(1,len(error)) * 2*np.pi/(state["L"]/state["frames"]), error[1:]
+
+    @staticmethod
+    def merge_sampling_states(states):
+        """run_parallel の各プロセスの update_sampling の state を 1 つにまとめる。無ければ None。"""
+        states = [state for state in states if state is not None and state["frames"] > 0]
+        if not states:
+            return None
+        size = max(len(state["sum"]) for state in states)
+        merged = dict(sum=np.zeros(size),count=np.zeros(size),frames=0,L=0.0)
+        for state in states:
+            merged["sum"][:len(state["sum"])] += state["sum"]
+            merged["count"][:len(state["count"])] += state["count"]
+            merged["frames"] += state["frames"]
+            merged["L"] += state["L"]
+        return merged
+
+    def sampling_summary(self):
+        """sampling_error_ をログに出し、"summary" の記録に加える dict にする。"""
+        if self.sampling_error_ is None:
+            return {}
+        q_shell, error = self.sampling_error_
+        self.log(f"sampling error of I(q): max {np.nanmax(error):.2e} (relative)")
+        return dict(sampling_error=dict(q=q_shell.tolist(),relative_error=error.tolist()))
+
+    def frames_before_end(self,times,end):
+        """times のうち end より前のフレーム数。"""
+        n_frames = 0
+        for t in times:
+            self.log(f"Frame number {t}")
+            self.log(t,end,int(t) >= end)
+            if int(t) >= end:
+                self.log("END")
+                break
+            n_frames += 1
+        return n_frames
+
+    def cache_key(self,query,groups):
+        """キャッシュのキー。振幅を変えるもの (ファイルの内容、選択、カーネル) だけから決める。"""
+        for path in (self.trr,self.gro):
+            if path not in self._fingerprints:
+                self._fingerprints[path] = file_fingerprint(path)
+        kernel = dict(kernel=self.kernel)
+        if self.kernel == "mesh":
+            kernel.update(mesh_order=self.mesh_order,mesh_oversample=self.mesh_oversample)
+        meta = json.dumps(dict(
+            trr=self._fingerprints[self.trr],gro=self._fingerprints[self.gro],
+            query=query,groups=groups,**kernel
+        ),sort_keys=True)
+        return hashlib.sha1(meta.encode()).hexdigest()
+
+    def cache_load(self,key,frame):
+        """キャッシュからフレームを読み込む。無ければ None。読んだファイルは最近使ったことにする。"""
+        path = os.path.join(self.cache,key,f"{frame}.npz")
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError,ValueError):
+            return None
+        return entry
+
+    @staticmethod
+    def cache_subset(entry,m):
+        """make_qset(entry["m"]) の振幅から make_qset(m) の q の分を取り出す (m <= entry["m"])。"""
+        if int(entry["m"]) == m:
+            return entry["F"]
+        # make_qset の q は (h,k,l) の辞書順なので、シェルで絞れば小さい集合と同じ並びになる
+        shell = make_qset(int(entry["m"]))[1]
+        return entry["F"][...,shell <= m-1]
+
+    def cache_store(self,key,frame,time,L,m,F):
+        """フレームの振幅をキャッシュに書き込む。書き込み中に落ちても壊れないよう一時ファイルから置き換える。"""
+        directory = os.path.join(self.cache,key)
+        os.makedirs(directory,exist_ok=True)
+        path = os.path.join(directory,f"{frame}.npz")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp,"wb") as f:
+            np.savez(f,time=time,L=L,m=m,F=np.asarray(F,dtype=np.complex64))
+        if self._cache_total is not None:
+            try:
+                # 同じフレームを書き直す場合は古いファイルの分を引く
+                self._cache_total -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            self._cache_total += os.path.getsize(tmp)
+        os.replace(tmp,path)
+
+    def cache_evict(self):
+        """
+        cache の合計が cache_size を超えていれば、最も長く使っていないファイルから消す。
+
+        合計は最初の呼び出しで 1 回だけ数え、以降は cache_store で足した値と比べるので、
+        ディレクトリを調べ直すのは上限を超えたときだけになる。別のプロセス (run_parallel) が
+        書いた分はそのときに数え直される。
+        """
+        if self._cache_total is None:
+            self._cache_total = self.cache_usage()
+        if self._cache_total <= self.cache_size:
+            return
+        files = []
+        for root, _, names in os.walk(self.cache):
+            for name in names:
+                if name.endswith(".npz"):
+                    path = os.path.join(root,name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime,stat.st_size,path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.cache_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # 別のプロセスが先に消した
+                pass
+            total -= size
+        self._cache_total = total
+
+    def cache_usage(self):
+        """cache にある .npz の合計バイト数。"""
+        total = 0
+        for root, _, names in os.walk(self.cache):
+            for name in names:
+                if name.endswith(".npz"):
+                    try:
+                        total += os.path.getsize(os.path.join(root,name))
+                    except FileNotFoundError:
+                        continue
+        return total
+
+    def open_timeseries(self,path,stride,n_labels,n_points=100,create=False):
+        """
+        フレームごとの I(q) を書き込む memmap (.npy) と時刻の memmap を開く。
+
+        行数は stride 後のフレーム数。create=True かつ形状が合わない (または存在しない)
+        場合は NaN で初期化して作り直す。
+
+        戻り値:
+            tuple: (I(q) の memmap (フレーム数,n_labels,n_points), 時刻の memmap (フレーム数,))
+        """
+        with md.open(self.trr) as f:
+            n_rows = -(-len(f)//stride)
+        time_path = os.path.splitext(path)[0] + "_time.npy"
+        shape = (n_rows,n_labels,n_points)
+        if os.path.exists(path) and os.path.exists(time_path):
+            series = np.load(path,mmap_mode="r+")
+            series_time = np.load(time_path,mmap_mode="r+")
+            if series.shape == shape and series_time.shape == (n_rows,):
+                return series, series_time
+            del series, series_time
+        if not create:
+            raise FileNotFoundError(f"{path} does not match this trajectory: create it with create=True")
+        series = np.lib.format.open_memmap(path,mode="w+",dtype=np.float32,shape=shape)
+        series[:] = np.nan
+        series_time = np.lib.format.open_memmap(time_path,mode="w+",dtype=np.float64,shape=(n_rows,))
+        series_time[:] = np.nan
+        series.flush()
+        series_time.flush()
+        return series, series_time
+
+    @staticmethod
+    def save_checkpoint(path,meta,acc,last_time,finished):
+        """
+        途中経過 (ProfileAccumulator の状態と最後に処理した時刻) を .npz に保存する。
+        書き込み中に落ちても前回の checkpoint が壊れないよう、一時ファイルから置き換える。
+        """
+        tmp = path + ".tmp"
+        with open(tmp,"wb") as f:
+            np.savez(
+                f,meta=np.array(meta),
+                last_time=np.nan if last_time is None else last_time,finished=finished,
+                **acc.state()
             )
-            endtime = time.time()
-            print(f"{endtime-starttime:.2f} second")
+        os.replace(tmp,path)
+
+    def load_checkpoint(self,path,meta):
+        """
+        checkpoint を読み込む。引数が一致しない場合は None を返す (最初から計算し直す)。
+
+        戻り値:
+            tuple or None: (ProfileAccumulator, last_time, finished)
+        """
+        with np.load(path) as data:
+            if str(data["meta"]) != meta:
+                self.log(f"{path} was written with different arguments: ignore it")
+                return None
+            last_time = float(data["last_time"])
+            return (
+                ProfileAccumulator.from_state(data),
+                None if np.isnan(last_time) else last_time,bool(data["finished"])
+            )
+
+    def default_dq(self):
+        """
+        binning="absolute" の既定のビン幅。.gro の箱の 2π/L (nm^-1)。
+
+        ビンは dq の整数倍を中心にするので、|h| が整数の格子点は箱が揺らいでも同じビンに入る。
+        """
+        L = md.load(self.gro).unitcell_lengths[0,0]
+        return float(2*np.pi/L)
+
+    @staticmethod
+    def n_points(maxq,binning="shell",dq=None):
+        """プロファイルの q 点数。"""
+        if binning == "absolute":
+            # 中心が maxq 以下のビン (0, dq, 2dq, ...)
+            return int(np.floor(maxq/dq)) + 1
+        return 100
+
+    @staticmethod
+    def absolute_bin_average(intensity,hs,weight,L,dq,n_bins):
+        """
+        1 フレームの |F(q)|^2 (または S_ab の各 q の値) を幅 dq の絶対 q のビンで平均する。
+
+        i 番目のビンは [(i-1/2)dq, (i+1/2)dq) で、shell の場合と同じく dq の整数倍を中心にする。
+        ビンの端を整数倍に置くと、dq = 2π/L のとき |h| が整数の格子点がちょうど端に乗り、
+        NPT でフレームの箱が .gro より大きいか小さいかで入るビンが変わってしまう。
+
+        引数:
+            intensity (np.ndarray): (M,) または (K,M)
+            hs (np.ndarray): 整数 q ベクトル (M,3)
+            weight (np.ndarray): q 点の重み (±q の多重度) (M,)
+
+        戻り値:
+            tuple: (ビン平均 (K,n_bins)、q 点の無いビンは 0, ビンごとの重みの和 (n_bins,))
+        """
+        q_abs = np.sqrt(np.sum(hs**2,axis=1)) * (2*np.pi/L)
+        idx = np.rint(q_abs/dq).astype(int)
+        keep = idx < n_bins
+        counts = np.bincount(idx[keep],weights=weight[keep],minlength=n_bins)
+        sums = np.stack([
+            np.bincount(idx[keep],weights=(weight*row)[keep],minlength=n_bins)
+            for row in np.atleast_2d(intensity)
+        ])
+        Iq = sums / np.where(counts > 0,counts,1)
+        Iq /= (L*10**(-7))**3
+        Iq *= (2.818e-13)**2
+        return Iq, counts
+
+    def write_profile(self,name,maxq,acc,groups,binning,dq):
+        """accumulate の結果を binning に応じた q 軸で .xvg に書き出す。"""
+        labels = self.profile_labels(groups)
+        if binning == "absolute":
+            counts = acc.weight[0]
+            filled = counts > 0
+            x = np.arange(len(counts)) * dq
+            self.write_xvg(
+                name,maxq,acc.mean[:,filled],labels=labels,err=acc.stderr()[:,filled],
+                x=x[filled],counts=counts[filled]
+            )
+        else:
+            self.write_xvg(name,maxq,acc.mean,labels=labels,err=acc.stderr())
+
+    def query_intensities(self,F_groups):
+        """
+        領域ごとの F (G,M) から各選択の |F|^2 と excess を求める (複数の query の場合)。
+
+        戻り値:
+            np.ndarray: (Q[+1],M)
+        """
+        F_query = self.query_members.astype(F_groups.real.dtype) @ F_groups
+        intensity = np.abs(F_query)**2
+        if "all" in self.query_names and "water" in self.query_names:
+            excess = intensity[self.query_names.index("all")] - intensity[self.query_names.index("water")]
+            intensity = np.vstack([intensity,excess])
+        return intensity
+
+    def profile_labels(self,groups=None):
+        """accumulate が返す各行の列名。複数の query の場合は select の後に呼ぶ。"""
+        if self.query_names is not None:
+            excess = "all" in self.query_names and "water" in self.query_names
+            return self.query_names + (["excess"] if excess else [])
+        if groups is None:
+            return ["y"]
+        return ["y"] + self.pair_names()
+
+    def write_xvg(self,name,maxq,Iq,labels=("y",),err=None,x=None,counts=None):
+        """
+        平均した I(q) を <trr>_<name>.xvg に書き出す。Iq は (P,) または (K,P)。
 
-        Iq = np.stack(Iq_save_list,axis=-1)
-        Iq = np.mean(Iq,axis=1)
-        print(np.stack([np.linspace(0,maxq,100),Iq],axis=1))
+        err (標準誤差、Iq と同じ形状) を渡すと各列の直後に誤差の列 (y なら dy、それ以外は <列名>_err) を置く。
+        x を省略すると 0..maxq の 100 点、counts を渡すと最後に count 列を置く。
+        """
+        x = np.linspace(0,maxq,100)[:,None] if x is None else np.asarray(x)[:,None]
+        Iq = np.atleast_2d(Iq)
+        columns = ["x"]
+        values = [x]
+        for k,label in enumerate(labels):
+            columns.append(label)
+            values.append(Iq[k][:,None])
+            if err is not None:
+                columns.append("dy" if label == "y" else f"{label}_err")
+                values.append(np.atleast_2d(err)[k][:,None])
+        if counts is not None:
+            columns.append("count")
+            values.append(np.asarray(counts)[:,None])
+        self.log(np.concatenate(values,axis=1))
         df = pd.DataFrame(
-            np.stack([np.linspace(0,maxq,100),Iq],axis=1),
-            columns=["x","y"]
+            np.concatenate(values,axis=1),
+            columns=columns
         )
         df = df.map(lambda x: '{0:.5f}'.format(x))
         df.to_csv(
             os.path.splitext(self.trr)[0]+"_"+name+".xvg",
             sep=" ",columns=None,index=None
         )
-        end = time.time()
-        print(f"\nend")
+        self.log(f"\nend")
 
-        
-    def calc_F(self,qs,coords):
-        a = torch.from_numpy(self.asf_a_arr).to(torch.float32)  # a_{j,k}
-        b = torch.from_numpy(self.asf_b_arr).to(torch.float32)  # (N,4)
-        c = torch.from_numpy(self.asf_c_arr).to(torch.float32)  # a_{j,k}
-        r = torch.from_numpy(coords).to(torch.float32)  # r_j (位置ベクトル)
-        q = torch.from_numpy(qs).to(torch.float32)  # r_j (位置ベクトル)
-        dataset = TensorDataset(q)
-        dataset2 = TensorDataset(a,b,c,r)
-        # DataLoader を使用して、データをバッチごとにロード
-        batch_size =5000
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
-        dataloader2 = DataLoader(dataset2, batch_size=batch_size, shuffle=False)
+    @staticmethod
+    def shell_average(intensity,shell,weight,maxq_int,L,verbose=True):
+        """
+        1 フレームの |F(q)|^2 (または S_ab の各 q の値) から、シェル 1, ..., maxq_int-1 の平均を求める。
+
+        引数:
+            intensity (np.ndarray): (M,) または (K,M)
+
+        戻り値:
+            np.ndarray: (maxq_int-1,) または (K,maxq_int-1)
+        """
+        # シェルごとに重み (±q の多重度) 付きで平均する
+        w_sum = np.bincount(shell,weights=weight,minlength=maxq_int)
+        Iq = np.stack([
+            np.bincount(shell,weights=weight*row,minlength=maxq_int)[1:maxq_int]
+            for row in np.atleast_2d(intensity)
+        ]) / w_sum[1:maxq_int]
+        Iq /= (L*10**(-7))**3
+        Iq *= (2.818e-13)**2
+        if verbose:
+            for i in range(1,maxq_int):
+                print(i*2*np.pi/L,Iq[0,i-1])
+        return Iq[0] if np.ndim(intensity) == 1 else Iq
+
+    def pair_intensities(self,F_groups):
+        """
+        グループ振幅 F_a(q) (G,M) から、全体の |F|^2 と Re F_a F_b* (a <= b) を並べた (1+P,M) を返す。
+        """
+        F_total = np.sum(F_groups,axis=0)
+        rows = [np.abs(F_total)**2]
+        for a in range(len(F_groups)):
+            for b in range(a,len(F_groups)):
+                rows.append(np.real(F_groups[a] * np.conj(F_groups[b])))
+        return np.stack(rows)
+
+    def calc_F_hkl(self,hs,coords,Ls,partial=False):
+        """
+        格子 q = (2π/L)(h,k,l) の F(q) を self.kernel のカーネルで計算する。
+
+        引数:
+            hs (np.ndarray): 整数 q ベクトル (M,3)
+            coords (np.ndarray): 原子座標 (T,N,3)
+            Ls (np.ndarray): 各フレームの箱の長さ (T,)
+
+        戻り値:
+            np.ndarray: 複素振幅 (T,M)。partial の場合は (T,G,M)
+        """
+        if self.kernel == "separable":
+            return self.calc_F_lattice(hs,coords,Ls,partial=partial)
+        if self.kernel == "mesh":
+            return self.calc_F_mesh(hs,coords,Ls,partial=partial)
+        qs = np.asarray(hs,dtype=np.float32)[None,:,:] * (2*np.pi/np.asarray(Ls)).astype(np.float32)[:,None,None]
+        return self.calc_F(qs,coords,partial=partial)
+
+    def detector_pattern(self,name,query="water",maxq=35,axis=2,stride=10,end=1000,frames_per_batch=1):
+        """
+        軸 axis に垂直で原点を通る逆格子面上の 2 次元散乱パターン I(q) をトラジェクトリ平均する。
+
+        面上の格子点 |h| <= maxq/(2π/L) をすべて評価するので、mesh カーネルと組み合わせると
+        FFT 1 回分のコストで済む。格子点の番号はフレームによらず共通で、q 軸は平均の箱の長さから求める。
+        結果は <trr>_<name>_2d.npz (q1, q2, I) に保存する。
+
+        引数:
+            axis (int): 面の法線の軸 (0, 1, 2)
+
+        戻り値:
+            tuple: (q1 (P,), q2 (P,), I (P,P))
+        """
+        chunk : md.Trajectory
+        atoms_idx = self.use_extract(self.select(query),stride,end)
+        L0 = md.load(self.gro).unitcell_lengths[0,0]
+        m = int(maxq/(2*np.pi/L0))
+        g = np.arange(-m,m+1)
+        plane = np.stack(np.meshgrid(g,g,indexing="ij"),axis=-1).reshape(-1,2)
+        hs = np.insert(plane,axis,0,axis=1)
+        inside = np.sum(plane**2,axis=1) <= m**2
+        total = np.zeros(len(hs))
+        L_sum = 0.0
+        n_frames = 0
+        with closing(self.iterload(frames_per_batch,stride)) as frames:
+            for chunk in frames:
+                use = np.flatnonzero(chunk.time < end)
+                if len(use) > 0:
+                    Ls = chunk.unitcell_lengths[use,0]
+                    F = self.calc_F_hkl(hs[inside],chunk.xyz[use][:,atoms_idx,:],Ls)  # (T,P)
+                    total[inside] += np.sum(np.abs(F)**2 / ((Ls[:,None]*10**(-7))**3),axis=0)
+                    L_sum += float(np.sum(Ls))
+                    n_frames += len(use)
+                if len(use) < len(chunk):
+                    break
+        if n_frames == 0:
+            raise ValueError(f"no frames before {end} ps in {self.trr}")
+        I = (total / n_frames * (2.818e-13)**2).reshape(len(g),len(g))
+        I[~inside.reshape(len(g),len(g))] = np.nan
+        q = g * (2*np.pi/(L_sum/n_frames))
+        np.savez(f"{os.path.splitext(self.trr)[0]}_{name}_2d.npz",q1=q,q2=q,I=I)
+        return q, q, I
+
+    def calc_F(self,qs,coords,partial=False):
+        """
+        構造因子の振幅 F(q) = Σ_j f_j(|q|) exp(i q・r_j) を計算する。
+
+        引数:
+            qs (np.ndarray): q ベクトル (M,3)、またはフレーム軸付きの (T,M,3)
+            coords (np.ndarray): 原子座標 (N,3)、またはフレーム軸付きの (T,N,3)
+            partial (bool): True ならグループごとの振幅 F_a(q) を返す
+
+        戻り値:
+            np.ndarray: 複素振幅 (M,) または (T,M)。partial の場合は (G,M) または (T,G,M)
+        """
+        single = np.ndim(coords) == 2
+        if single:
+            qs = qs[None]
+            coords = coords[None]
+        with self.stage("form_factors"):
+            # 元素ごとの形状因子 f_e(|q|)
+            f = cromer_mann(
+                self.asf_a_arr.astype(np.float32),self.asf_b_arr.astype(np.float32),
+                self.asf_c_arr.astype(np.float32),np.sum(np.asarray(qs,dtype=np.float32)**2,axis=2)
+            )  # (T,E,M)
+        with self.stage("kernel"):
+            if self.backend == "numpy":
+                F = self._track_peak(self._calc_F_numpy,qs,coords,f)
+            else:
+                device = "cuda" if self.backend == "cuda" else "cpu"
+                F = self._track_peak(self._calc_F_torch,qs,coords,f,device)
+            F = self.combine_components(F,partial)
+        return F[0] if single else F
+
+    def _track_peak(self,func,*args):
+        """
+        max_memory が指定されている場合、func 実行中のメモリのピークを peak_memory に記録する。
+
+        numpy は tracemalloc、cuda は torch のアロケータの統計で実測する。torch-cpu には
+        アロケータの統計が無いので、タイルサイズを決めたときの見積もりを使う。
+        """
+        if self.max_memory is None:
+            return func(*args)
+        if self.backend == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            out = func(*args)
+            peak = torch.cuda.max_memory_allocated() - base
+        elif self.backend == "numpy":
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            out = func(*args)
+            peak = tracemalloc.get_traced_memory()[1] - base
+            if started:
+                tracemalloc.stop()
+        else:
+            out = func(*args)
+            peak = self._estimated_peak
+        self.peak_memory = max(self.peak_memory,peak)
+        return out
+
+    def _direct_tiles(self,n_frames,n_q,n_atoms,n_workers):
+        """
+        direct カーネルの (q のタイル, 原子のタイル) を max_memory から決める。
+
+        1 タイルあたり phase, cos, sin の (T, 原子, q) 配列が 3 つと、q ごとの形状因子・部分和が
+        必要になる。入力のコピーと出力はタイルに依らず確保される。
+        """
+        if self.max_memory is None:
+            return 5000, max(1,5000//n_frames)
+        n_elements = len(self.asf_elements)
+        n_components = len(self.asf_component_element)
+        max_component = int(np.max(np.bincount(self.asf_group))) if n_atoms > 0 else 1
+        fixed = n_frames * (n_atoms*3*4*2 + n_q*3*4 + n_q*n_components*8*2 + n_q*8 + n_q*n_elements*4)
+        budget = (self.max_memory - fixed) / n_workers
+        per_q = n_frames * (n_elements*4*2 + n_components*8 + 8)
+        per_pair = n_frames * 4 * 3
+        atom_tile = int(min(max_component,np.sqrt(max(budget,0) / per_pair)))
+        q_tile = int(min(n_q,budget / (per_pair*max(atom_tile,1) + per_q))) if atom_tile >= 1 else 0
+        if atom_tile < 1 or q_tile < 1:
+            raise MemoryError(
+                f"max_memory={self.max_memory} bytes is too small for {n_frames} frames: "
+                f"at least {fixed + n_workers*(per_pair + per_q)} bytes are needed"
+            )
+        # q が少なくて余った分は原子のタイルに回す
+        atom_tile = int(min(max_component,(budget - q_tile*per_q) / (per_pair*q_tile)))
+        self._estimated_peak = int(fixed + n_workers*(q_tile*per_q + per_pair*atom_tile*q_tile))
+        return q_tile, atom_tile
+
+    def combine_components(self,F_components,partial):
+        """
+        成分 (元素, グループ) ごとの振幅 (T,C,M) を、グループごと (T,G,M) または全体 (T,M) にまとめる。
+        """
+        if not partial:
+            return np.sum(F_components,axis=1)
+        F = np.zeros(
+            (F_components.shape[0],len(self.group_names),F_components.shape[2]),
+            dtype=F_components.dtype
+        )
+        for comp,g in enumerate(self.asf_component_group):
+            F[:,g] += F_components[:,comp]
+        return F
+
+    def _calc_F_numpy(self,qs,coords,f):
+        r = np.asarray(coords,dtype=np.float32)  # (T,N,3)
+        q = np.asarray(qs,dtype=np.float32)  # (T,M,3)
+        n_frames = r.shape[0]
+        # 成分ごとに原子座標をまとめておく
+        r_groups = [r[:,self.asf_group == comp] for comp in range(len(self.asf_component_element))]
+        batch_size, atom_batch = self._direct_tiles(n_frames,q.shape[1],r.shape[1],self.n_threads)
+
+        def _batch(start):
+            batch_q = q[:,start:start+batch_size]  # (T,q_num,3)
+            f_batch = f[:,:,start:start+batch_size]  # (T,E,q_num)
+            q_num = batch_q.shape[1]
+            F_batch = np.zeros((n_frames,len(r_groups),q_num),dtype=np.complex64)
+            for comp,r_e in enumerate(r_groups):
+                # 同じ成分の原子について位相因子 exp(i q・r_j) を足し合わせる
+                S_real = np.zeros((n_frames,q_num),dtype=np.float32)
+                S_imag = np.zeros((n_frames,q_num),dtype=np.float32)
+                for j in range(0,r_e.shape[1],atom_batch):
+                    phase = r_e[:,j:j+atom_batch] @ batch_q.transpose(0,2,1)  # (T,N_e,q_num)
+                    S_real += np.sum(np.cos(phase), axis=1)
+                    S_imag += np.sum(np.sin(phase), axis=1)
+                F_batch[:,comp] = f_batch[:,self.asf_component_element[comp]] * (S_real + 1j * S_imag)
+            return F_batch
+
+        # numpy の ufunc は GIL を解放するので q のバッチをスレッドに分配する
+        starts = range(0,q.shape[1],batch_size)
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            F_list = list(executor.map(_batch,starts))
+        if len(F_list) == 0:
+            return np.zeros((n_frames,len(r_groups),0),dtype=np.complex64)
+        return np.concatenate(F_list,axis=2)  # (T,C,M)
+
+    def _calc_F_torch(self,qs,coords,f,device):
+        r = torch.from_numpy(np.ascontiguousarray(coords)).to(device=device,dtype=torch.float32)  # (T,N,3)
+        q = torch.from_numpy(np.ascontiguousarray(qs)).to(device=device,dtype=torch.float32)  # (T,M,3)
+        n_frames = r.size(0)
+        group = torch.from_numpy(self.asf_group).to(device=device)
+        r_groups = [r[:,group == comp] for comp in range(len(self.asf_component_element))]
+        batch_size, atom_batch = self._direct_tiles(n_frames,q.size(1),r.size(1),1)
         F_real_list = []  # F_real を保存するリスト
         F_imag_list = []
-        r_gpu = r.to("cuda")
-        for batch_q in dataloader:
-            batch_q = batch_q[0]
-            batch_q = batch_q.to(device="cuda")
-            q_num = batch_q.size()[0]
-            # e^{-||q||} の計算
-            q_norm = torch.norm(batch_q, dim=1) # (q_num)
-            q_norm = q_norm.unsqueeze(0)
-            inner_sum_list = []
-            for batch_a,batch_b,batch_c,batch_r in dataloader2:
-                batch_a = batch_a.to(device="cuda")
-                batch_b = batch_b.to(device="cuda")
-                batch_c = batch_c.to(device="cuda")
-                batch_r = batch_r.to(device="cuda")
-                b_extend = batch_b.unsqueeze(-1)
-                exp_q_norm = torch.exp(-torch.matmul(b_extend,q_norm.pow(2) / (16 * torch.pi**2 * 100)))  # (N,4,q_num)
-                # jごとの内部和を計算
-                inner_sum = torch.sum(torch.stack([batch_a for _ in range(q_num)],dim=-1) * exp_q_norm, dim=1) + torch.cat([batch_c for _ in range(q_num)],dim=-1)  # (N,q_num)
-                inner_sum_list.append(inner_sum)
-            inner_sum = torch.cat(inner_sum_list, dim=0)
-            # q ⋅ r_j の計算
-            phase = torch.matmul(r_gpu, batch_q.t())  # qとrの内積 (num_atoms, num_q)
-            phase_real = torch.cos(phase)
-            phase_imag = torch.sin(phase)
-            # F の実部と虚部を更新
-            F_real = torch.sum(inner_sum * phase_real, dim=0)  # (num_atoms,)と(num_atoms, num_q)の積
-            F_imag = torch.sum(inner_sum * phase_imag, dim=0)  # (num_atoms,)と(num_atoms, num_q)の積
+        for start in range(0,q.size(1),batch_size):
+            batch_q = q[:,start:start+batch_size]  # (T,q_num,3)
+            f_batch = torch.from_numpy(np.ascontiguousarray(f[:,:,start:start+batch_size])).to(device)  # (T,E,q_num)
+            shape = (n_frames,batch_q.size(1))
+            F_real = torch.zeros((n_frames,len(r_groups),batch_q.size(1)),device=device)
+            F_imag = torch.zeros((n_frames,len(r_groups),batch_q.size(1)),device=device)
+            for comp,r_e in enumerate(r_groups):
+                S_real = torch.zeros(shape,device=device)
+                S_imag = torch.zeros(shape,device=device)
+                for j in range(0,r_e.size(1),atom_batch):
+                    # q ⋅ r_j の計算
+                    phase = torch.matmul(r_e[:,j:j+atom_batch], batch_q.transpose(1,2))  # (T,N_e,q_num)
+                    S_real += torch.sum(torch.cos(phase), dim=1)
+                    S_imag += torch.sum(torch.sin(phase), dim=1)
+                e = int(self.asf_component_element[comp])
+                F_real[:,comp] = f_batch[:,e] * S_real
+                F_imag[:,comp] = f_batch[:,e] * S_imag
             F_real_list.append(F_real)
             F_imag_list.append(F_imag)
-
-        del q_norm, exp_q_norm, b_extend,inner_sum
-        del phase, phase_real, phase_imag
-        torch.cuda.empty_cache()
+        if len(F_real_list) == 0:
+            return np.zeros((n_frames,len(r_groups),0),dtype=np.complex64)
         # 結果の複素数形式
-        F_real = torch.cat(F_real_list, dim=0)  # (num_q,)
-        F_imag = torch.cat(F_imag_list, dim=0)  # (num_q,)
-        F = F_real + 1j * F_imag
-        F = F.to("cpu").numpy()
-        del a, b, c, r
-        torch.cuda.empty_cache()
-        # 結果を表示
+        F_real = torch.cat(F_real_list, dim=2)  # (T,C,num_q)
+        F_imag = torch.cat(F_imag_list, dim=2)  # (T,C,num_q)
+        F = F_real.to("cpu").numpy() + 1j * F_imag.to("cpu").numpy()
+        if device == "cuda":
+            torch.cuda.empty_cache()
         return F
+
+
+    def calc_F_lattice(self,hs,coords,Ls,partial=False):
+        """
+        格子 q = (2π/L)(h,k,l) に対する F(q) を、軸ごとの位相表の積で計算する。
+
+        exp(i q・r_j) = X_j^h Y_j^k Z_j^l (X_j = exp(2πi x_j/L) など) と分解できるので、
+        三角関数はフレームごとに O(N・m) 回だけで済む。h を固定すると (k,l) についての和は
+        (X_j^h Y_j^k) と Z_j^l の行列積になる。
+
+        引数:
+            hs (np.ndarray): 整数 q ベクトル (M,3)
+            coords (np.ndarray): 原子座標 (T,N,3)
+            Ls (np.ndarray): 各フレームの箱の長さ (T,)
+            partial (bool): True ならグループごとの振幅 F_a(q) を返す
+
+        戻り値:
+            np.ndarray: 複素振幅 (T,M)。partial の場合は (T,G,M)
+        """
+        hs = np.asarray(hs)
+        m = int(np.abs(hs).max()) if len(hs) > 0 else 0
+        # h ごとに、その h を持つ q の位置と (k,l) の範囲をまとめる
+        planes = []
+        for h in np.unique(hs[:,0]):
+            pos = np.flatnonzero(hs[:,0] == h)
+            k, l = hs[pos,1], hs[pos,2]
+            planes.append((h,pos,k.min(),k.max(),l.min(),l.max(),k-k.min(),l-l.min()))
+        Ls = np.asarray(Ls,dtype=np.float64)
+        with self.stage("form_factors"):
+            q_norm2 = (np.sum(hs**2,axis=1)[None,:] * ((2*np.pi/Ls)**2)[:,None]).astype(np.float32)  # (T,M)
+            f = cromer_mann(
+                self.asf_a_arr.astype(np.float32),self.asf_b_arr.astype(np.float32),
+                self.asf_c_arr.astype(np.float32),q_norm2
+            )  # (T,E,M)
+        atom_batch = self._lattice_tile(len(Ls),len(hs),m,np.shape(coords)[1])
+        with self.stage("kernel"):
+            if self.backend == "numpy":
+                S = self._track_peak(self._lattice_sums_numpy,planes,len(hs),m,coords,Ls,atom_batch)
+            else:
+                device = "cuda" if self.backend == "cuda" else "cpu"
+                S = self._track_peak(self._lattice_sums_torch,planes,len(hs),m,coords,Ls,atom_batch,device)
+            S *= f[:,self.asf_component_element]  # (T,C,M)
+            return self.combine_components(S,partial)
+
+    def _lattice_tile(self,n_frames,n_q,m,n_atoms):
+        """
+        separable カーネルの原子のタイルを max_memory から決める。
+
+        原子 1 個あたり、3 軸 × (2m+1) 次の位相表 (角度、cos, sin, 複素数) と成分ごとの
+        コピー、(X^h Y^k) の行が必要になる。
+        """
+        if self.max_memory is None:
+            return max(1,n_atoms)
+        n_components = len(self.asf_component_element)
+        width = 2*m + 1
+        fixed = n_frames*n_q*(n_components*8 + len(self.asf_elements)*4*2) + width*width*8
+        per_atom = width * (3*4*3 + 3*8*2 + 3*8 + 8)
+        atom_tile = int(min(n_atoms,(self.max_memory - fixed) / per_atom))
+        if atom_tile < 1:
+            raise MemoryError(
+                f"max_memory={self.max_memory} bytes is too small: at least {fixed + per_atom} bytes are needed"
+            )
+        self._estimated_peak = int(fixed + per_atom*atom_tile)
+        return atom_tile
+
+    def _lattice_sums_numpy(self,planes,n_q,m,coords,Ls,atom_batch):
+        """成分ごとの Σ_j exp(i q・r_j) を (T,C,M) で返す。原子は atom_batch 個ずつ処理する。"""
+        powers = np.arange(-m,m+1,dtype=np.float32)
+        n_components = len(self.asf_component_element)
+        S = np.zeros((len(Ls),n_components,n_q),dtype=np.complex64)
+        for t in range(len(Ls)):
+            for j in range(0,np.shape(coords)[1],atom_batch):
+                base = np.asarray(coords[t,j:j+atom_batch],dtype=np.float32) * np.float32(2*np.pi/Ls[t])  # (N,3)
+                angle = base[:,:,None] * powers  # (N,3,2m+1)
+                table = (np.cos(angle) + 1j * np.sin(angle)).astype(np.complex64)
+                del angle
+                group = self.asf_group[j:j+atom_batch]
+                for comp in range(n_components):
+                    X, Y, Z = (table[group == comp,axis] for axis in range(3))
+                    if len(X) == 0:
+                        continue
+                    for h,pos,k0,k1,l0,l1,k_off,l_off in planes:
+                        A = X[:,h+m,None] * Y[:,k0+m:k1+m+1]  # (N_e,K)
+                        B = A.T @ Z[:,l0+m:l1+m+1]  # (K,L)
+                        S[t,comp,pos] += B[k_off,l_off]
+        return S
+
+    def _lattice_sums_torch(self,planes,n_q,m,coords,Ls,atom_batch,device):
+        """_lattice_sums_numpy と同じ計算を torch で行う。"""
+        powers = torch.arange(-m,m+1,dtype=torch.float32,device=device)
+        group = torch.from_numpy(self.asf_group).to(device=device)
+        n_components = len(self.asf_component_element)
+        planes = [
+            (h,torch.from_numpy(pos).to(device),k0,k1,l0,l1,
+             torch.from_numpy(k_off).to(device),torch.from_numpy(l_off).to(device))
+            for h,pos,k0,k1,l0,l1,k_off,l_off in planes
+        ]
+        S = torch.zeros((len(Ls),n_components,n_q),dtype=torch.complex64,device=device)
+        for t in range(len(Ls)):
+            for j in range(0,np.shape(coords)[1],atom_batch):
+                r = torch.from_numpy(np.ascontiguousarray(coords[t,j:j+atom_batch])).to(device=device,dtype=torch.float32)
+                base = r * float(2*np.pi/Ls[t])
+                table = torch.polar(torch.ones(1,device=device),base[:,:,None] * powers)  # (N,3,2m+1)
+                group_tile = group[j:j+atom_batch]
+                for comp in range(n_components):
+                    X, Y, Z = (table[group_tile == comp,axis] for axis in range(3))
+                    if X.size(0) == 0:
+                        continue
+                    for h,pos,k0,k1,l0,l1,k_off,l_off in planes:
+                        A = X[:,h+m,None] * Y[:,k0+m:k1+m+1]  # (N_e,K)
+                        B = A.T @ Z[:,l0+m:l1+m+1]  # (K,L)
+                        S[t,comp,pos] += B[k_off,l_off]
+        S = S.to("cpu").numpy()
+        if device == "cuda":
+            torch.cuda.empty_cache()
+        return S
+
+    def calc_F_mesh(self,hs,coords,Ls,partial=False):
+        """
+        格子 q = (2π/L)(h,k,l) に対する F(q) を particle-mesh 法で計算する。
+
+        成分ごとに原子を次数 mesh_order の B-spline で K^3 の周期グリッドへ割り当て、
+        1 回の 3 次元 FFT で全格子点の Σ_j exp(i q・r_j) を得る。割り当ての窓関数は
+        Euler の指数スプラインの係数 b(h) = 1/Σ_j M_p(j) exp(-2πi h j/K) で補正する (SPME と同じ)。
+        コストは O(N・p^3 + K^3 log K) で q の数にほぼ依らない。
+
+        引数・戻り値は calc_F_lattice と同じ。
+        """
+        hs = np.asarray(hs)
+        m = int(np.abs(hs).max()) if len(hs) > 0 else 0
+        K = fft_size(int(np.ceil(self.mesh_oversample*(2*m+1))))
+        M_int = bspline_weights(0.0,self.mesh_order)  # M_p(0), ..., M_p(p-1)
+        b = 1 / (np.exp(-2j*np.pi*np.outer(np.arange(K),np.arange(self.mesh_order))/K) @ M_int)  # (K,)
+        idx = hs % K
+        correction = (b[idx[:,0]] * b[idx[:,1]] * b[idx[:,2]]).astype(np.complex64)  # (M,)
+        Ls = np.asarray(Ls,dtype=np.float64)
+        with self.stage("form_factors"):
+            q_norm2 = (np.sum(hs**2,axis=1)[None,:] * ((2*np.pi/Ls)**2)[:,None]).astype(np.float32)  # (T,M)
+            f = cromer_mann(
+                self.asf_a_arr.astype(np.float32),self.asf_b_arr.astype(np.float32),
+                self.asf_c_arr.astype(np.float32),q_norm2
+            )  # (T,E,M)
+        atom_batch = self._mesh_tile(len(Ls),len(hs),K,np.shape(coords)[1])
+        with self.stage("kernel"):
+            if self.backend == "numpy":
+                S = self._track_peak(self._mesh_sums_numpy,idx,K,coords,Ls,atom_batch)
+            else:
+                device = "cuda" if self.backend == "cuda" else "cpu"
+                S = self._track_peak(self._mesh_sums_torch,idx,K,coords,Ls,atom_batch,device)
+            S *= correction
+            S *= f[:,self.asf_component_element]  # (T,C,M)
+            return self.combine_components(S,partial)
+
+    def _mesh_tile(self,n_frames,n_q,K,n_atoms):
+        """
+        mesh カーネルの原子のタイルを max_memory から決める。
+
+        グリッドは 1 成分ずつ作るので、常に要るのは 1 成分分のグリッド (実数) と、np.bincount の結果
+        または FFT の入力 (複素数に直したもの) と出力のどちらか大きい方。原子 1 個あたりには、
+        _mesh_spread の (3,p) の配列 (B-spline の漸化式の途中の配列を含む)、(p,p) の途中の積、
+        p^3 個のグリッド番号と重みが要る。
+        """
+        if self.max_memory is None:
+            return max(1,n_atoms)
+        n_components = len(self.asf_component_element)
+        p = self.mesh_order
+        fixed = n_frames*n_q*(n_components*8 + len(self.asf_elements)*4*2) + K**3*(8 + 16*2)
+        per_atom = p**3*(8 + 8) + p**2*8*2 + 3*p*8*8 + 3*8*4
+        atom_tile = int(min(n_atoms,(self.max_memory - fixed) / per_atom))
+        if atom_tile < 1:
+            raise MemoryError(
+                f"max_memory={self.max_memory} bytes is too small: at least {fixed + per_atom} bytes are needed"
+            )
+        self._estimated_peak = int(fixed + per_atom*atom_tile)
+        return atom_tile
+
+    def _mesh_spread(self,r,L,K):
+        """原子座標 (N,3) から B-spline のグリッド番号 (N,p^3) と重み (N,p^3) を求める。"""
+        p = self.mesh_order
+        u = np.mod(np.asarray(r,dtype=np.float64) * (K/L),K)
+        base = np.floor(u).astype(np.int64)
+        W = bspline_weights(u - base,p)  # (N,3,p)
+        grid = np.mod(base[:,:,None] - np.arange(p),K)  # (N,3,p)
+        flat = (grid[:,0,:,None,None]*K + grid[:,1,None,:,None])*K + grid[:,2,None,None,:]
+        weight = W[:,0,:,None,None] * W[:,1,None,:,None] * W[:,2,None,None,:]
+        return flat.reshape(len(u),-1), weight.reshape(len(u),-1)
+
+    def _mesh_sums_numpy(self,idx,K,coords,Ls,atom_batch):
+        """成分ごとの Σ_j exp(i q・r_j) を (T,C,M) で返す。グリッドは 1 成分ずつ作って FFT する。"""
+        n_components = len(self.asf_component_element)
+        S = np.zeros((len(Ls),n_components,len(idx)),dtype=np.complex64)
+        members = [np.flatnonzero(self.asf_group == comp) for comp in range(n_components)]
+        Q = np.zeros(K**3)
+        for t in range(len(Ls)):
+            for comp in range(n_components):
+                Q[:] = 0
+                for j in range(0,len(members[comp]),atom_batch):
+                    flat, weight = self._mesh_spread(coords[t,members[comp][j:j+atom_batch]],Ls[t],K)
+                    Q += np.bincount(flat.ravel(),weights=weight.ravel(),minlength=K**3)
+                # Σ_k Q(k) exp(+2πi h・k/K) は Q が実数なので FFT の複素共役
+                S[t,comp] = np.conj(np.fft.fftn(Q.reshape(K,K,K))[idx[:,0],idx[:,1],idx[:,2]])
+        return S
+
+    def _mesh_sums_torch(self,idx,K,coords,Ls,atom_batch,device):
+        """_mesh_sums_numpy と同じ計算を torch で行う (グリッドへの割り当ては numpy)。"""
+        n_components = len(self.asf_component_element)
+        idx = torch.from_numpy(idx).to(device)
+        S = torch.zeros((len(Ls),n_components,len(idx)),dtype=torch.complex64,device=device)
+        members = [np.flatnonzero(self.asf_group == comp) for comp in range(n_components)]
+        Q = torch.zeros(K**3,dtype=torch.float32,device=device)
+        for t in range(len(Ls)):
+            for comp in range(n_components):
+                Q.zero_()
+                for j in range(0,len(members[comp]),atom_batch):
+                    flat, weight = self._mesh_spread(coords[t,members[comp][j:j+atom_batch]],Ls[t],K)
+                    Q.index_add_(
+                        0,torch.from_numpy(flat.ravel()).to(device),
+                        torch.from_numpy(weight.ravel()).to(device=device,dtype=torch.float32)
+                    )
+                S[t,comp] = torch.conj(torch.fft.fftn(Q.view(K,K,K))[idx[:,0],idx[:,1],idx[:,2]])
+        S = S.to("cpu").numpy()
+        if device == "cuda":
+            torch.cuda.empty_cache()
+        return S
+
+
+class ProfileAccumulator:
+    """
+    フレームごとの I(q) プロファイルから、平均・分散とブロック平均を逐次的に求める。
+
+    全フレームを保持しないのでメモリはトラジェクトリの長さに依存しない。
+    平均と分散は重み付きの Welford 法、別プロセスの結果の統合は Chan らの方法で行う。
+    重みは q 点の数などの要素ごとの値で、重み 0 の要素はそのフレームでは更新されない。
+    """
+
+    def __init__(self,shape,block_size=None):
+        """
+        引数:
+            shape (tuple): 1 フレーム分のプロファイルの形状
+            block_size (int, optional): ブロック平均に使うフレーム数
+        """
+        self.block_size = block_size
+        self.count = 0
+        self.weight = np.zeros(shape)
+        self.weight2 = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+        self.block_sum = np.zeros(shape)
+        self.block_weight = np.zeros(shape)
+        self.block_n = 0
+        self.n_blocks = np.zeros(shape)
+        self.block_mean = np.zeros(shape)
+        self.block_M2 = np.zeros(shape)
+
+    def add(self,Iq,weight=None):
+        """
+        1 フレーム分のプロファイルを加える。
+
+        引数:
+            Iq (np.ndarray): フレームのプロファイル
+            weight (np.ndarray, optional): 要素ごとの重み (Iq に broadcast できる形状)。None なら 1。
+        """
+        w = np.ones_like(self.mean) if weight is None else np.broadcast_to(weight,self.mean.shape)
+        self.count += 1
+        self.weight2 += w**2
+        self._update(Iq,w,"weight","mean","M2")
+        if self.block_size:
+            self.block_sum += w * np.where(w > 0,Iq,0)
+            self.block_weight += w
+            self.block_n += 1
+            if self.block_n == self.block_size:
+                has_data = self.block_weight > 0
+                block = self.block_sum / np.where(has_data,self.block_weight,1)
+                self._update(block,has_data.astype(float),"n_blocks","block_mean","block_M2")
+                self.block_sum[:] = 0
+                self.block_weight[:] = 0
+                self.block_n = 0
+
+    def _update(self,x,w,weight_name,mean_name,M2_name):
+        W = getattr(self,weight_name) + w
+        mean = getattr(self,mean_name)
+        has_data = w > 0
+        delta = np.where(has_data,x - mean,0)
+        mean = mean + delta * w / np.where(W > 0,W,1)
+        M2 = getattr(self,M2_name) + w * delta * np.where(has_data,x - mean,0)
+        setattr(self,weight_name,W)
+        setattr(self,mean_name,mean)
+        setattr(self,M2_name,M2)
+
+    def merge(self,other):
+        """
+        別のフレーム範囲の結果を統合する。どちらの半端なブロックも誤差の見積もりには使わない。
+        """
+        self.count += other.count
+        self.weight2 = self.weight2 + other.weight2
+        self.weight, self.mean, self.M2 = self._combine(
+            (self.weight,self.mean,self.M2),(other.weight,other.mean,other.M2)
+        )
+        self.n_blocks, self.block_mean, self.block_M2 = self._combine(
+            (self.n_blocks,self.block_mean,self.block_M2),(other.n_blocks,other.block_mean,other.block_M2)
+        )
+        self.block_sum[:] = 0
+        self.block_weight[:] = 0
+        self.block_n = 0
+
+    @staticmethod
+    def _combine(left,right):
+        W_a, mean_a, M2_a = left
+        W_b, mean_b, M2_b = right
+        W = W_a + W_b
+        safe = np.where(W > 0,W,1)
+        delta = mean_b - mean_a
+        mean = mean_a + delta * W_b / safe
+        M2 = M2_a + M2_b + delta**2 * W_a * W_b / safe
+        return W, mean, M2
+
+    def variance(self):
+        """フレーム間の不偏分散 (重み付きの場合は有効サンプル数で補正)。"""
+        n_eff = self.weight**2 / np.where(self.weight2 > 0,self.weight2,1)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            return np.where(n_eff > 1,self.M2 / self.weight * n_eff / (n_eff - 1),np.nan)
+
+    def stderr(self):
+        """
+        平均の標準誤差。ブロックが 2 個以上あればブロック平均のばらつきから、
+        そうでなければフレームを独立とみなして求める。
+        """
+        n_eff = self.weight**2 / np.where(self.weight2 > 0,self.weight2,1)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            frame_err = np.sqrt(self.variance() / n_eff)
+            if not self.block_size:
+                return frame_err
+            block_err = np.sqrt(self.block_M2 / (self.n_blocks - 1) / self.n_blocks)
+        return np.where(self.n_blocks >= 2,block_err,frame_err)
+
+    def state(self):
+        """checkpoint 用に状態を配列の辞書として返す。"""
+        return dict(
+            acc_block_size=-1 if self.block_size is None else self.block_size,
+            acc_count=self.count,acc_block_n=self.block_n,
+            **{f"acc_{name}": getattr(self,name) for name in self._ARRAYS}
+        )
+
+    _ARRAYS = (
+        "weight","weight2","mean","M2","block_sum","block_weight",
+        "n_blocks","block_mean","block_M2"
+    )
+
+    @classmethod
+    def from_state(cls,data):
+        """state() で保存した状態から復元する。"""
+        block_size = int(data["acc_block_size"])
+        acc = cls(data["acc_mean"].shape,block_size=None if block_size < 0 else block_size)
+        acc.count = int(data["acc_count"])
+        acc.block_n = int(data["acc_block_n"])
+        for name in cls._ARRAYS:
+            setattr(acc,name,data[f"acc_{name}"].copy())
+        return acc
+
+def _waxs_worker(job):
+    """
+    run_parallel の 1 プロセス分。ProcessPoolExecutor で pickle できるようモジュール関数にしている。
+
+    戻り値:
+        tuple: (ProfileAccumulator, サンプリング誤差の積算 (update_sampling の state、無ければ None))
+    """
+    gro, trr, init_kwargs, kwargs = job
+    waxs = WaxsCalculator(gro,trr,**init_kwargs)
+    acc = waxs.accumulate(**kwargs)
+    return acc, waxs._sampling_state
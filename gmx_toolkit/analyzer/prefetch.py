@@ -0,0 +1,92 @@
+import threading
+import queue
+
+
+class Prefetcher:
+    """
+    イテレータの要素を別スレッドで先に取り出し、最大 depth 個までキューに溜めておく。
+
+    md.iterload のチャンクの読み込み・デコードを計算と重ねるために使う。numpy や torch の
+    計算は GIL を解放するので、その間に読み込みスレッドが次のチャンクを用意できる。
+    読み込み側で起きた例外は、その要素を取り出したときに呼び出し側で送出する。
+    途中で使うのをやめる場合は close() を呼ぶ (with 文なら自動で呼ばれる)。
+
+    使い方:
+        with Prefetcher(md.iterload(trr,top=gro,chunk=10),depth=2) as chunks:
+            for chunk in chunks:
+                ...
+    """
+
+    _END = object()
+
+    def __init__(self,iterable,depth=2,transform=None):
+        """
+        引数:
+            iterable: 先読みするイテレータ (md.iterload など)
+            depth (int): キューに溜める要素数の上限
+            transform (callable, optional): 読み込みスレッドで各要素に適用する関数
+                (原子の選択やコピーなど、計算側から外したい前処理)
+        """
+        self.queue = queue.Queue(maxsize=max(1,depth))
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(
+            target=self._produce,args=(iter(iterable),transform),daemon=True
+        )
+        self._thread.start()
+
+    def _produce(self,iterator,transform):
+        try:
+            for item in iterator:
+                if transform is not None:
+                    item = transform(item)
+                if not self._put((item,None)):
+                    return
+        except BaseException as error:
+            self._put((self._END,error))
+            return
+        finally:
+            # 途中でやめた場合もファイルを閉じる
+            if hasattr(iterator,"close"):
+                iterator.close()
+        self._put((self._END,None))
+
+    def _put(self,entry):
+        # close() されたら待つのをやめる
+        while not self._stop.is_set():
+            try:
+                self.queue.put(entry,timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item, error = self.queue.get()
+        if item is self._END:
+            self._done = True
+            self._thread.join()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        """読み込みスレッドを止める。キューに残った要素は捨てる。"""
+        self._stop.set()
+        self._done = True
+        self._thread.join()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
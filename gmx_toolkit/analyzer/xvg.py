@@ -0,0 +1,146 @@
+import re
+import mmap
+import warnings
+import numpy as np
+import pandas as pd
+
+# xmgrace の指示行 (@)、コメント (#)、データセットの区切り (&)
+_SKIP = (b"@",b"#",b"&")
+_LEGEND = re.compile(r'@\s*s(\d+)\s+legend\s+"(.*)"')
+_LABEL = re.compile(r'@\s*(title|subtitle|xaxis\s+label|yaxis\s+label)\s+"(.*)"')
+
+
+def read_xvg_header(path):
+    """
+    .xvg の先頭の @ / # の行を読み、列名とラベルを返す。
+
+    列名は 1 列目が "X"、残りは "@ sN legend" の名前 (無ければ "Y"、複数なら "Y0","Y1",...)。
+    @ 行の代わりに列名だけの行 (WaxsCalculator.write_xvg の出力など) があればそれを使う。
+
+    戻り値:
+        tuple: (列名のリスト, attrs (title, xlabel, ylabel, legends), データの開始バイト位置)
+    """
+    attrs = {}
+    legends = {}
+    names = None
+    offset = 0
+    n_columns = None
+    with open(path,"rb") as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped[:1] in _SKIP:
+                text = stripped.decode("utf-8",errors="replace")
+                match = _LEGEND.match(text)
+                if match:
+                    legends[int(match.group(1))] = match.group(2)
+                match = _LABEL.match(text)
+                if match:
+                    key = match.group(1).replace(" ","").replace("axislabel","label")
+                    attrs[key] = match.group(2)
+                offset += len(line)
+                continue
+            fields = stripped.split()
+            try:
+                [float(field) for field in fields]
+            except ValueError:
+                if names is not None:
+                    raise ValueError(f"non-numeric line at byte {offset} of {path}")
+                # 列名の行
+                names = [field.decode("utf-8",errors="replace") for field in fields]
+                offset += len(line)
+                continue
+            n_columns = len(fields)
+            break
+    if names is None:
+        n_columns = n_columns or len(legends) + 1
+        n_y = n_columns - 1
+        names = ["X"] + [
+            legends.get(k,"Y" if n_y == 1 else f"Y{k}") for k in range(n_y)
+        ]
+    attrs["legends"] = [legends[k] for k in sorted(legends)]
+    return names, attrs, offset
+
+
+def _parse_block(block,n_columns):
+    """改行で終わるバイト列を (行数,n_columns) の float64 にする。"""
+    if any(mark in block for mark in _SKIP):
+        block = b"\n".join(line for line in block.split(b"\n") if line.lstrip()[:1] not in _SKIP)
+    try:
+        with warnings.catch_warnings():
+            # 数値でない部分で止まった場合は下で 1 行ずつ読み直してエラーにする
+            warnings.simplefilter("ignore",DeprecationWarning)
+            values = np.fromstring(block.decode("ascii",errors="replace"),sep=" ")
+    except ValueError:
+        values = None
+    if values is not None and values.size % n_columns == 0:
+        rows = values.reshape(-1,n_columns)
+        # 行ごとの列数がそろっているかは行数で確かめる (空行があるときだけ数え直す)
+        n_lines = block.count(b"\n") + (not block.endswith(b"\n"))
+        if len(rows) == n_lines or len(rows) == sum(1 for line in block.split(b"\n") if line.strip()):
+            return rows
+    # 列数が行によって違う場合は 1 行ずつ読み、足りない列は NaN にする
+    rows = []
+    for line in block.split(b"\n"):
+        fields = line.split()
+        if fields:
+            row = np.full(n_columns,np.nan)
+            try:
+                row[:min(len(fields),n_columns)] = np.array(fields[:n_columns],dtype=np.float64)
+            except ValueError:
+                raise ValueError(f"non-numeric line in xvg data: {line.decode(errors='replace')!r}") from None
+            rows.append(row)
+    return np.array(rows).reshape(-1,n_columns)
+
+
+def iter_xvg(path,chunk_size=2**26):
+    """
+    .xvg を chunk_size バイトずつ読み、DataFrame を順に返すジェネレータ。
+
+    メモリに収まらないファイルはこれで少しずつ処理する。ファイルは mmap で開き、
+    改行で区切った塊ごとに numpy で数値にする。途中の @ / # / & の行は読み飛ばす。
+
+    引数:
+        path (str): .xvg ファイル
+        chunk_size (int): 一度に数値にするバイト数の目安
+
+    yield:
+        pd.DataFrame: 列名と attrs は read_xvg_header と同じ。
+    """
+    names, attrs, offset = read_xvg_header(path)
+    with open(path,"rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空のファイルは mmap できない
+            return
+        with data:
+            while offset < len(data):
+                stop = min(offset + chunk_size,len(data))
+                if stop < len(data):
+                    newline = data.find(b"\n",stop)
+                    stop = len(data) if newline < 0 else newline + 1
+                df = pd.DataFrame(_parse_block(data[offset:stop],len(names)),columns=names)
+                df.attrs.update(attrs)
+                yield df
+                offset = stop
+
+
+def read_xvg(path,chunk_size=2**26):
+    """
+    .xvg (gmx の出力、または列名の行と空白区切りの数値の表) を読み、float の DataFrame にする。
+
+    列名は "@ sN legend" から付け、タイトルと軸のラベルは attrs に入れる。
+
+    引数:
+        path (str): .xvg ファイル
+        chunk_size (int): iter_xvg の chunk_size
+
+    戻り値:
+        pd.DataFrame: 1 列目が X、続く列が各データ。
+    """
+    names, attrs, _ = read_xvg_header(path)
+    chunks = [chunk.to_numpy() for chunk in iter_xvg(path,chunk_size=chunk_size)]
+    values = np.concatenate(chunks) if chunks else np.zeros((0,len(names)))
+    df = pd.DataFrame(values,columns=names)
+    df.attrs.update(attrs)
+    return df
@@ -1,4 +1,6 @@
 import os
+import struct
+import signal
 import subprocess
 import numpy as np
 import mdtraj as md
@@ -442,14 +444,24 @@ class RunThrow:
         run_command_with_input(grompp)
         run_command_with_input(mdrun)
 
-    def run_npt(self, T, run_ns=5,grps=["SOL"]):
+    def run_npt(self, T, run_ns=5,grps=["SOL"], adaptive=False, min_ns=1.0, window_ns=1.0,
+                rtol=5e-3, check_interval=60):
         """
         NPT（定温定圧）シミュレーションを実行します。
 
         GROMACSのNPTシミュレーションを実行し、指定された温度と圧力でシステムを緩和します。
+        adaptive=True のときは run_ns を上限として mdrun を走らせ、書き出されていく .edr を
+        check_interval 秒ごとに読んで密度とポテンシャルエネルギーの収束を判定します（check_convergence）。
+        収束したら mdrun に SIGINT を送り、次の近傍探索のステップでチェックポイントと最終構造（.gro）を
+        書かせて止めます。判定の結果は self.npt_convergence に入ります。
 
         :param T: 目標温度（K）
-        :param run_ns: シミュレーション時間（ns）
+        :param run_ns: シミュレーション時間（ns）。adaptive=True では上限
+        :param adaptive: 収束したところで NPT を打ち切るか（bool）
+        :param min_ns: 収束を判定し始める時間（ns）
+        :param window_ns: 判定に使う末尾の区間の長さ（ns）
+        :param rtol: 区間内のドリフトの許容値（平均の絶対値に対する割合）
+        :param check_interval: .edr を読む間隔（秒）
         """
         RunThrow.generate_npt_mdp(temperature=T, run_ns=run_ns,grps=grps)
         tpr = os.path.splitext(self.topfile)[0]
@@ -459,7 +471,114 @@ class RunThrow:
         grompp = f"gmx grompp -c {prev_tpr}.tpr.gro -p {self.topfile} -f npt.mdp -o {tpr}.tpr"
         mdrun = f"gmx mdrun -s {tpr}.tpr -deffnm {os.path.basename(tpr)}.tpr -cpi {tpr}.tpr.cpt"
         run_command_with_input(grompp)
-        run_command_with_input(mdrun)
+        if not adaptive:
+            run_command_with_input(mdrun)
+            return
+        deffnm = f"{os.path.basename(tpr)}.tpr"
+        self.npt_convergence = RunThrow.run_until_converged(
+            mdrun, f"{deffnm}.edr", min_ns=min_ns, window_ns=window_ns, rtol=rtol,
+            check_interval=check_interval
+        )
+        if not os.path.exists(f"{deffnm}.gro"):
+            raise RuntimeError(f"mdrun stopped without writing {deffnm}.gro")
+
+    @staticmethod
+    def run_until_converged(mdrun, edr, min_ns=1.0, window_ns=1.0, rtol=5e-3, check_interval=60,
+                            terms=("Density", "Potential")):
+        """
+        mdrun を実行し、.edr の terms が収束したら止めます。
+
+        mdrun の出力は {edr の拡張子を除いたもの}.out に書きます。収束しないまま nsteps に達した場合は
+        そのまま終わるのを待ちます。
+
+        :param mdrun: gmx mdrun のコマンド（str）
+        :param edr: mdrun が書き出す .edr ファイル
+        :param terms: 収束を判定する項目（tuple）
+        :param その他: run_npt と同じ
+        :return: 最後の判定の結果（check_convergence の dict）
+        """
+        report = dict(converged=False, time_ns=0.0, terms={})
+        stopped = False
+        out_path = f"{os.path.splitext(edr)[0]}.out"
+        with open(out_path, "w") as out:
+            process = subprocess.Popen(mdrun.split(), stdout=out, stderr=subprocess.STDOUT, text=True)
+            try:
+                while True:
+                    try:
+                        process.wait(timeout=check_interval)
+                        break
+                    except subprocess.TimeoutExpired:
+                        pass
+                    if stopped or not os.path.exists(edr):
+                        continue
+                    report = RunThrow.check_convergence(edr, min_ns, window_ns, rtol, terms)
+                    if report["converged"]:
+                        print(f"NPT converged at {report['time_ns']:.3f} ns: stopping mdrun")
+                        # mdrun は 1 回目の SIGINT で次の近傍探索のステップまで進め、通常の終了と同じく
+                        # チェックポイントと最終構造を書いて止まる
+                        process.send_signal(signal.SIGINT)
+                        stopped = True
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+        if process.returncode != 0:
+            with open(out_path) as f:
+                print(f.read())
+            raise subprocess.CalledProcessError(process.returncode, mdrun)
+        return report
+
+    @staticmethod
+    def check_convergence(edr, min_ns=1.0, window_ns=1.0, rtol=5e-3, terms=("Density", "Potential")):
+        """
+        書き出し途中の .edr を読み、terms が収束しているかを判定します。
+
+        末尾の window_ns の区間に直線を当てはめ、区間全体でのドリフト d = 傾き × 区間の長さと、
+        その標準誤差 σ（自己相関の分だけ統計的非効率 g で広げたもの）を求めます。
+        すべての項目で |d| < 2σ（有意なドリフトが無い）かつ 2σ <= rtol × |平均|（rtol 程度のドリフトを
+        見分けられるだけのデータがある）なら収束とします。経過時間が min_ns と window_ns に満たない間は判定しません。
+
+        :param edr: .edr ファイル
+        :param terms: 判定する項目（tuple）
+        :param その他: run_npt と同じ
+        :return: dict（converged, time_ns, terms: {項目名: dict(mean, drift, drift_error)}）
+        """
+        from gmx_toolkit.analyzer.edr import read_edr
+        from gmx_toolkit.analyzer.fluctuation import statistical_inefficiency
+
+        report = dict(converged=False, time_ns=0.0, terms={})
+        try:
+            data = read_edr(edr)
+        except (EOFError, struct.error):
+            # ヘッダを書き込み中で、まだ読めない
+            return report
+        if len(data) == 0:
+            # 項目名の途中で切れていることがあるので、フレームが書かれるまでは項目を確かめない
+            return report
+        missing = [term for term in terms if term not in data.columns[2:]]
+        if missing:
+            raise KeyError(f"{missing} not in {edr}: choose from {list(data.columns[2:])}")
+        t = data["Time"].to_numpy() / 1000
+        report["time_ns"] = float(t[-1])
+        if t[-1] - t[0] < max(min_ns, window_ns):
+            return report
+        window = t >= t[-1] - window_ns
+        if window.sum() < 10:
+            return report
+        t = t[window]
+        converged = True
+        for term in terms:
+            y = data[term].to_numpy()[window]
+            dt = t - t.mean()
+            slope = dt @ (y - y.mean()) / (dt @ dt)
+            residual = y - y.mean() - slope * dt
+            g = statistical_inefficiency(residual)
+            slope_error = np.sqrt(residual @ residual / (len(y) - 2) / (dt @ dt) * g)
+            drift, drift_error = slope * window_ns, slope_error * window_ns
+            report["terms"][term] = dict(mean=float(y.mean()), drift=float(drift), drift_error=float(drift_error))
+            converged &= abs(drift) < 2 * drift_error <= rtol * abs(y.mean())
+        report["converged"] = bool(converged)
+        return report
 
     def run_production(self, T, run_ns=5,grps=["SOL"]):
         """